@@ -0,0 +1,102 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# boto3 is imported on first use so events that never reach AWS don't pay for it.
+_clients = {}
+# boto3 resources and their Tables aren't thread-safe, and batch_handler runs
+# conversations on a thread pool, so each thread builds its own from its own session
+_local = threading.local()
+_registered_tables = {}
+_lock = threading.Lock()
+construction_ms = {}
+
+_registered = set()
+
+# boto3 takes timeouts per client, not per call: a budgeted client reads for at
+# most its dependency's budget and doesn't retry, so a call can't outlast the
+# budget; deadline_helper skips calls that no longer fit the invocation.
+CONNECT_TIMEOUT = float(os.environ.get("aws_connect_timeout", 3.05))
+
+
+def _build(key, factory):
+    start = time.perf_counter()
+    built = factory()
+    construction_ms[key] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(f"Built AWS client {key} in {construction_ms[key]}ms")
+    return built
+
+
+def _budget_config(budget):
+    from botocore.config import Config
+    from deadline_helper import BUDGETS
+    read_timeout = BUDGETS[budget]
+    return Config(connect_timeout=min(CONNECT_TIMEOUT, read_timeout), read_timeout=read_timeout,
+                  retries={"max_attempts": 1, "mode": "standard"})
+
+
+def get_client(service_name, budget=None):
+    """
+    Returns the shared boto3 client for the service, built once on first use.
+    budget names a deadline_helper dependency: its client gets that timeout
+    and no retries, e.g. get_client("lambda", budget="translation").
+    """
+    key = service_name if budget is None else f"{service_name}:{budget}"
+    client = _clients.get(key)
+    if client is None and service_name in _registered:
+        return _clients[service_name]
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+                config = _budget_config(budget) if budget else None
+                client = _clients[key] = _build(key, lambda: boto3.client(service_name, config=config))
+    return client
+
+
+def get_table(table_name):
+    """
+    Returns the calling thread's DynamoDB Table for the table name, built once
+    per thread on first use. Registered tables are shared by all threads.
+    """
+    table = _registered_tables.get(table_name)
+    if table is not None:
+        return table
+    tables = getattr(_local, "tables", None)
+    if tables is None:
+        tables = _local.tables = {}
+    table = tables.get(table_name)
+    if table is None:
+        resource = getattr(_local, "dynamodb", None)
+        if resource is None:
+            import boto3
+            resource = _local.dynamodb = _build("dynamodb",
+                                                lambda: boto3.session.Session().resource("dynamodb"))
+        table = tables[table_name] = resource.Table(table_name)
+    return table
+
+
+def register_client(service_name, client):
+    # Installs a ready-made client, e.g. a local stand-in for benchmarks; budgeted lookups get it too
+    _clients[service_name] = client
+    _registered.add(service_name)
+
+
+def register_table(table_name, table):
+    _registered_tables[table_name] = table
+
+
+def reset():
+    # Forgets every built or registered client
+    with _lock:
+        _clients.clear()
+        _registered.clear()
+        _registered_tables.clear()
+        construction_ms.clear()
+    # Other threads' resources are dropped when the threads exit
+    _local.__dict__.clear()
@@ -0,0 +1,100 @@
+"""
+Cold-start benchmark: import time and first-event latency per event type.
+
+Every sample runs in a fresh interpreter against the local stand-ins, so it
+measures what a new Lambda container pays before and during its first event.
+AWS calls go through real boto3 clients pointed at the stub server, so the
+first event includes importing boto3 and building the clients it needs. The
+time spent building clients is also reported on its own, from
+aws_helper.construction_ms.
+
+    python -m benchmarks.cold_start --runs 5
+    python -m benchmarks.cold_start --max-import-ms 400 --max-first-event-ms 250
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("boto3", "botocore", "requests")
+
+
+def _child(event_type):
+    # Runs inside the fresh interpreter and prints one JSON sample
+    import logging
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, ROOT)
+    from benchmarks import fakes, fixtures
+
+    stack = fakes.install(aws_endpoint=True)
+    fixtures.seed(stack)
+    start = time.perf_counter()
+    import lambda_function
+    imported = time.perf_counter()
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    lambda_function.lambda_handler(fixtures.EVENTS[event_type](), None)
+    first = time.perf_counter()
+    import aws_helper
+    clients_ms = sum(aws_helper.construction_ms.values())
+    lambda_function.lambda_handler(fixtures.EVENTS[event_type](), None)
+    second = time.perf_counter()
+    stack.http.stop()
+    print(json.dumps({
+        "import_ms": (imported - start) * 1000,
+        "first_event_ms": (first - imported) * 1000,
+        "aws_clients_ms": clients_ms,
+        "aws_clients": sorted(aws_helper.construction_ms),
+        "warm_event_ms": (second - first) * 1000,
+        "heavy_modules_at_import": heavy
+    }))
+
+
+def sample(event_type):
+    output = subprocess.run([sys.executable, "-m", "benchmarks.cold_start", "--child", event_type],
+                            cwd=ROOT, capture_output=True, text=True, check=True,
+                            env=dict(os.environ, metrics_enabled="false"))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--event", action="append", help="event type(s) to run, default all")
+    parser.add_argument("--max-import-ms", type=float, help="fail when the median import time is higher")
+    parser.add_argument("--max-first-event-ms", type=float, help="fail when a median first-event latency is higher")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        return _child(args.child)
+
+    sys.path.insert(0, ROOT)
+    from benchmarks.fixtures import EVENTS
+
+    failed = False
+    print(f"{'event':<24}{'import ms':>12}{'first ms':>12}{'aws ms':>12}{'warm ms':>12}"
+          f"  heavy imports / aws clients built")
+    for event_type in args.event or EVENTS:
+        samples = [sample(event_type) for _ in range(args.runs)]
+        import_ms = statistics.median(s["import_ms"] for s in samples)
+        first_ms = statistics.median(s["first_event_ms"] for s in samples)
+        clients_ms = statistics.median(s["aws_clients_ms"] for s in samples)
+        warm_ms = statistics.median(s["warm_event_ms"] for s in samples)
+        heavy = ",".join(samples[0]["heavy_modules_at_import"]) or "-"
+        clients = ",".join(samples[0]["aws_clients"]) or "-"
+        print(f"{event_type:<24}{import_ms:>12.1f}{first_ms:>12.1f}{clients_ms:>12.1f}{warm_ms:>12.1f}"
+              f"  {heavy} / {clients}")
+        if args.max_import_ms is not None and import_ms > args.max_import_ms:
+            print(f"  import time {import_ms:.1f}ms is over {args.max_import_ms}ms")
+            failed = True
+        if args.max_first_event_ms is not None and first_ms > args.max_first_event_ms:
+            print(f"  first event {first_ms:.1f}ms is over {args.max_first_event_ms}ms")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+End-to-end benchmark: warm lambda_handler latency per event type against the
+local stand-ins, with the calls each event makes to every dependency.
+
+    python -m benchmarks.end_to_end --iterations 200
+    python -m benchmarks.end_to_end --event message_carousel --lambda-latency 0.05 --cold-caches
+    python -m benchmarks.end_to_end --json > results.json
+
+Latencies are in seconds and are added to every call of that dependency.
+Call counts and DynamoDB bytes are averages per event.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(samples, pct):
+    # Nearest-rank percentile of an already sorted list
+    if not samples:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def summarize(durations_ms, percentiles=PERCENTILES):
+    ordered = sorted(durations_ms)
+    summary = {f"p{pct}_ms": round(percentile(ordered, pct), 2) for pct in percentiles}
+    summary["mean_ms"] = round(statistics.fmean(ordered), 2) if ordered else 0.0
+    summary["max_ms"] = round(ordered[-1], 2) if ordered else 0.0
+    return summary
+
+
+def clear_caches():
+    # Drops every warm-container cache so each event pays for its lookups again
+    import db_helper
+    import kendra_helper
+    import translation_helper
+    from benchmarks import fixtures
+    from token_helper import token_manager
+
+    db_helper.invalidate_caches()
+    kendra_helper.kendra_cache.invalidate()
+    translation_helper.translation_cache.invalidate()
+    token_manager.invalidate({"zoom_auth": fixtures.ZOOM_AUTH}, fixtures.ACCOUNT_ID)
+
+
+def run_event(stack, lambda_function, event_factory, iterations, warmup, cold_caches):
+    """
+    Runs one event type and returns its latency summary and per-event call counts
+    """
+    for _ in range(warmup):
+        lambda_function.lambda_handler(event_factory(), None)
+
+    durations = []
+    totals = {}
+    stack.reset_counters()
+    for _ in range(iterations):
+        if cold_caches:
+            clear_caches()
+        event = event_factory()
+        start = time.perf_counter()
+        lambda_function.lambda_handler(event, None)
+        durations.append((time.perf_counter() - start) * 1000)
+    for name, count in stack.counters().items():
+        totals[name] = round(count / iterations, 2)
+    return {"latency": summarize(durations), "calls": totals}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--event", action="append", help="event type(s) to run, default all")
+    parser.add_argument("--dynamodb-latency", type=float, default=0.0)
+    parser.add_argument("--http-latency", type=float, default=0.0)
+    parser.add_argument("--lambda-latency", type=float, default=0.0)
+    parser.add_argument("--kendra-latency", type=float, default=0.0)
+    parser.add_argument("--translation", action="store_true", help="seed the client with translation enabled")
+    parser.add_argument("--cold-caches", action="store_true", help="clear the warm-container caches before every event")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("metrics_enabled", "false")
+    from benchmarks import fakes, fixtures
+
+    stack = fakes.install(dynamodb_latency=args.dynamodb_latency, http_latency=args.http_latency,
+                          lambda_latency=args.lambda_latency, kendra_latency=args.kendra_latency)
+    import lambda_function
+    logging.disable(logging.CRITICAL)
+
+    results = {}
+    try:
+        for event_type in args.event or fixtures.EVENTS:
+            # Reseeded per event type so transcript growth doesn't carry over
+            fixtures.seed(stack, translation=args.translation)
+            results[event_type] = run_event(stack, lambda_function, fixtures.EVENTS[event_type],
+                                            args.iterations, args.warmup, args.cold_caches)
+    finally:
+        stack.http.stop()
+        logging.disable(logging.NOTSET)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    return 0
+
+
+def print_table(results):
+    columns = [f"p{pct}_ms" for pct in PERCENTILES] + ["max_ms"]
+    print(f"{'event':<24}" + "".join(f"{column:>10}" for column in columns))
+    for event_type, result in results.items():
+        print(f"{event_type:<24}" + "".join(f"{result['latency'][column]:>10.2f}" for column in columns))
+        calls = ", ".join(f"{name}={count:g}" for name, count in sorted(result["calls"].items()) if count)
+        print(f"{'':<24}{calls}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
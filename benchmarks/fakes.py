@@ -0,0 +1,540 @@
+"""
+Local stand-ins for DynamoDB, Lambda, Kendra and the Zoom/Haptik HTTP APIs.
+
+install() points the handler at them: tables and clients are registered in
+aws_helper and the HTTP base URLs are pointed at a local stub server. It has
+to run before lambda_function (and the helpers) are imported, because the
+base URLs are read at import time. With aws_endpoint=True nothing is
+registered; the stub server also speaks the DynamoDB, Lambda and Kendra wire
+protocols, and aws_helper builds real boto3 clients against it.
+"""
+import copy
+import decimal
+import io
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_OPERAND = re.compile(r"\s*(if_not_exists|list_append)\s*\(")
+_LAMBDA_INVOKE = re.compile(r"^/2015-03-31/functions/([^/]+)/invocations$")
+# Request and response members holding items in DynamoDB's typed wire format
+_ITEM_MEMBERS = ("Key", "Item", "ExclusiveStartKey", "ExpressionAttributeValues",
+                 "Attributes", "LastEvaluatedKey")
+
+
+def _size(value):
+    # Approximate item size: JSON text, with binary values counted at their length
+    return len(json.dumps(value, default=lambda other: "." * len(other)
+                          if isinstance(other, (bytes, bytearray)) else str(other)))
+
+
+def _project(item, projection, names):
+    # Keeps only the attributes of a ProjectionExpression
+    if not projection:
+        return item
+    attributes = {names.get(part.strip(), part.strip()) for part in projection.split(",")}
+    return {name: value for name, value in item.items() if name in attributes}
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class _Exceptions:
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+
+
+class FakeTable:
+    """
+    In-memory DynamoDB table supporting the expression subset the handler uses
+    """
+
+    def __init__(self, name, key_names=("user_id",), latency=0.0):
+        self.name = name
+        self.key_names = tuple(key_names)
+        self.latency = latency
+        self.items = {}
+        self.calls = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.meta = type("Meta", (), {"client": type("Client", (), {"exceptions": _Exceptions})()})()
+        self._lock = threading.Lock()
+
+    def seed(self, *items):
+        for item in items:
+            self.items[self._key(item)] = copy.deepcopy(item)
+        return self
+
+    def reset_counters(self):
+        self.calls = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _key(self, key):
+        return tuple(key[name] for name in self.key_names)
+
+    def _count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        self._count("get_item")
+        with self._lock:
+            item = self.items.get(self._key(Key))
+            if item is None:
+                return {}
+            item = copy.deepcopy(_project(item, ProjectionExpression, ExpressionAttributeNames or {}))
+        self.bytes_read += _size(item)
+        return {"Item": item}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        self._count("put_item")
+        with self._lock:
+            key = self._key(Item)
+            if ConditionExpression:
+                self._check(ConditionExpression, self.items.get(key, {}),
+                            ExpressionAttributeNames or {}, ExpressionAttributeValues or {})
+            self.items[key] = copy.deepcopy(Item)
+        self.bytes_written += _size(Item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self._count("delete_item")
+        with self._lock:
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ConditionExpression=None, ReturnValues="NONE", **kwargs):
+        self._count("update_item")
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        with self._lock:
+            key = self._key(Key)
+            item = copy.deepcopy(self.items.get(key, {}))
+            if ConditionExpression:
+                self._check(ConditionExpression, item, names, values)
+            if not item:
+                item = dict(Key)
+            for action, body in re.findall(r"(?i)\b(set|remove)\s+(.*?)(?=\s+(?:set|remove)\s+|$)",
+                                           UpdateExpression.strip()):
+                for clause in self._split(body):
+                    if action.lower() == "remove":
+                        item.pop(names.get(clause.strip(), clause.strip()), None)
+                        continue
+                    target, expression = clause.split("=", 1)
+                    target = names.get(target.strip(), target.strip())
+                    item[target] = self._evaluate(expression.strip(), item, names, values)
+            self.items[key] = item
+        self.bytes_written += _size(item)
+        if ReturnValues in ("ALL_NEW", "UPDATED_NEW"):
+            # UPDATED_NEW is answered with the whole item, a superset of the updated attributes
+            return {"Attributes": copy.deepcopy(item)}
+        return {}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames=None,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, **kwargs):
+        # Supports "<hash> = :v" optionally followed by "AND <range> > :v" (or >=, <, <=)
+        self._count("query")
+        names = ExpressionAttributeNames or {}
+        conditions = [part.strip() for part in re.split(r"(?i)\s+and\s+", KeyConditionExpression)]
+        with self._lock:
+            items = [copy.deepcopy(item) for item in self.items.values()
+                     if all(self._compare(condition, item, names, ExpressionAttributeValues)
+                            for condition in conditions)]
+        if len(self.key_names) > 1:
+            items.sort(key=lambda item: item[self.key_names[1]], reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = self._key(ExclusiveStartKey)
+            positions = [self._key(item) for item in items]
+            items = items[positions.index(start) + 1:] if start in positions else items
+        response = {}
+        if Limit and len(items) > Limit:
+            items = items[:Limit]
+            response["LastEvaluatedKey"] = {name: items[-1][name] for name in self.key_names}
+        self.bytes_read += sum(_size(item) for item in items)
+        response["Items"] = items
+        return response
+
+    def scan(self, **kwargs):
+        self._count("scan")
+        with self._lock:
+            items = [copy.deepcopy(item) for item in self.items.values()]
+        self.bytes_read += sum(_size(item) for item in items)
+        return {"Items": items}
+
+    @staticmethod
+    def _split(body, separator=","):
+        # Splits on separators that are not inside function calls
+        parts, depth, current = [], 0, ""
+        for char in body:
+            if char == separator and depth == 0:
+                parts.append(current)
+                current = ""
+                continue
+            depth += char == "("
+            depth -= char == ")"
+            current += char
+        parts.append(current)
+        return [part.strip() for part in parts if part.strip()]
+
+    def _evaluate(self, expression, item, names, values):
+        expression = expression.strip()
+        terms = self._split(expression, "+")
+        if len(terms) > 1:
+            total = self._evaluate(terms[0], item, names, values)
+            for term in terms[1:]:
+                total = total + self._evaluate(term, item, names, values)
+            return total
+        match = _OPERAND.match(expression)
+        if match:
+            arguments = self._split(expression[match.end():-1])
+            if match.group(1) == "if_not_exists":
+                attribute = names.get(arguments[0], arguments[0])
+                if attribute in item:
+                    return item[attribute]
+                return self._evaluate(arguments[1], item, names, values)
+            return list(self._evaluate(arguments[0], item, names, values)) + \
+                list(self._evaluate(arguments[1], item, names, values))
+        if expression.startswith(":"):
+            return copy.deepcopy(values[expression])
+        return item.get(names.get(expression, expression))
+
+    def _compare(self, condition, item, names, values):
+        function = re.match(r"(attribute_exists|attribute_not_exists)\s*\(\s*([#\w]+)\s*\)", condition)
+        if function:
+            exists = names.get(function.group(2), function.group(2)) in item
+            return exists if function.group(1) == "attribute_exists" else not exists
+        left, operator, right = re.match(r"([#:\w]+)\s*(<=|>=|<>|=|<|>)\s*([#:\w]+)", condition).groups()
+        left = self._evaluate(left, item, names, values)
+        right = self._evaluate(right, item, names, values)
+        if left is None or right is None:
+            return operator == "<>" and left != right
+        return {"=": left == right, "<>": left != right, "<": left < right,
+                "<=": left <= right, ">": left > right, ">=": left >= right}[operator]
+
+    def _check(self, expression, item, names, values):
+        # OR of ANDs, without parentheses
+        for alternative in re.split(r"(?i)\s+or\s+", expression):
+            if all(self._compare(condition.strip(), item, names, values)
+                   for condition in re.split(r"(?i)\s+and\s+", alternative)):
+                return
+        raise ConditionalCheckFailedException(f"The conditional request failed: {expression}")
+
+
+class _BatchWriter:
+    # Table.batch_writer() stand-in; writes go through one by one
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+
+class FakeLambdaClient:
+    """
+    Records invokes. RequestResponse invokes of the translation service answer
+    with "translated_message", like the real service. With batch=True it also
+    answers a "messages" list with "translated_messages".
+    """
+
+    def __init__(self, latency=0.0, batch=False):
+        self.latency = latency
+        self.batch = batch
+        self.invokes = []
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload="{}", **kwargs):
+        with self._lock:
+            self.invokes.append({"FunctionName": FunctionName, "InvocationType": InvocationType,
+                                 "Payload": Payload})
+        if self.latency:
+            time.sleep(self.latency)
+        request = json.loads(Payload)
+        response = {}
+        if InvocationType == "RequestResponse":
+            if "messages" in request:
+                if self.batch:
+                    response["translated_messages"] = [f"[t] {message}" for message in request["messages"]]
+            else:
+                response["translated_message"] = f"[t] {request.get('message')}"
+        return {"StatusCode": 202 if InvocationType == "Event" else 200,
+                "Payload": io.BytesIO(json.dumps(response).encode())}
+
+
+class FakeKendraClient:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.queries = []
+
+    def query(self, QueryText, IndexId, **kwargs):
+        self.queries.append(QueryText)
+        if self.latency:
+            time.sleep(self.latency)
+        return {"ResultItems": [
+            {"Type": "ANSWER", "DocumentExcerpt": {"Text": f"Answer for {QueryText}"}},
+            {"Type": "DOCUMENT", "DocumentExcerpt": {"Text": "Knowledge article"},
+             "DocumentURI": "https://kb.example.com/articles/reset password"}
+        ]}
+
+
+class StubHTTPServer:
+    """
+    Local HTTP server answering the Zoom OAuth, Zoom chat and Haptik history endpoints
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = {}
+        self.bytes_received = 0
+        self.responses = {}
+        # An AWSProtocol once AWS calls are served too
+        self.aws = None
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Buffered writes send headers and body in one segment; otherwise
+            # delayed ACKs add ~40ms to every keep-alive request.
+            wbufsize = -1
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, headers=None, content_type="application/json"):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self):
+                path = self.path.split("?")[0]
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                target = self.headers.get("X-Amz-Target")
+                if stub.aws and (target or _LAMBDA_INVOKE.match(path)):
+                    # Counted by the stand-ins themselves
+                    return self._reply(*stub.aws.call(target, path, self.headers, body))
+                stub._record(path, len(body))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                override = stub.responses.get(path)
+                if override:
+                    return self._reply(*override(body))
+                if path.endswith("/oauth/token"):
+                    return self._reply(200, {"access_token": "local-token", "expires_in": 3599})
+                if path.endswith("/v2/im/chat/messages"):
+                    return self._reply(201, {"id": f"msg-{stub.requests[path]}", "channel": "local-channel"})
+                if "get_chat_history" in path:
+                    return self._reply(200, {"chat_text": "10:00:00 01-01-2024 [User]: hi"})
+                return self._reply(404, {"error": path})
+
+            do_GET = _handle
+            do_POST = _handle
+
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def _record(self, path, size):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.bytes_received += size
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = {}
+            self.bytes_received = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AWSProtocol:
+    """
+    Answers boto3's DynamoDB (JSON 1.0), Lambda Invoke (REST) and Kendra Query
+    (JSON 1.1) requests from the stand-ins, for real clients pointed at the
+    stub server with AWS_ENDPOINT_URL
+    """
+
+    def __init__(self, tables, lambda_client, kendra_client):
+        self.tables = {table.name: table for table in tables.values()}
+        self.lambda_client = lambda_client
+        self.kendra_client = kendra_client
+        # Built on the first DynamoDB call, so boto3 isn't imported before the handler is
+        self._deserializer = None
+        self._serializer = None
+
+    def call(self, target, path, headers, body):
+        # Returns the stub server's reply arguments: status, body, headers, content type
+        invoke = _LAMBDA_INVOKE.match(path)
+        if invoke:
+            response = self.lambda_client.invoke(
+                FunctionName=invoke.group(1), Payload=body.decode() or "{}",
+                InvocationType=headers.get("X-Amz-Invocation-Type", "RequestResponse"))
+            return response["StatusCode"], response["Payload"].read(), None, "application/json"
+        service, _, operation = target.partition(".")
+        request = json.loads(body or b"{}")
+        if service.startswith("AWSKendra"):
+            return 200, self.kendra_client.query(**request), None, "application/x-amz-json-1.1"
+        try:
+            return 200, self._dynamodb(operation, request), None, "application/x-amz-json-1.0"
+        except ConditionalCheckFailedException as ex:
+            error = {"__type": "com.amazonaws.dynamodb.v20120810#ConditionalCheckFailedException",
+                     "message": str(ex) or "The conditional request failed"}
+            return 400, error, None, "application/x-amz-json-1.0"
+
+    def _dynamodb(self, operation, request):
+        if self._serializer is None:
+            from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+            self._deserializer = TypeDeserializer()
+            self._serializer = TypeSerializer()
+        if operation == "BatchWriteItem":
+            for table_name, writes in request["RequestItems"].items():
+                with self.tables[table_name].batch_writer() as batch:
+                    for write in writes:
+                        if "PutRequest" in write:
+                            batch.put_item(Item=self._load(write["PutRequest"]["Item"]))
+                        else:
+                            batch.delete_item(Key=self._load(write["DeleteRequest"]["Key"]))
+            return {"UnprocessedItems": {}}
+        table = self.tables[request.pop("TableName")]
+        request = {name: self._load(value) if name in _ITEM_MEMBERS else value
+                   for name, value in request.items()}
+        # GetItem -> get_item
+        method = re.sub(r"(?<!^)(?=[A-Z])", "_", operation).lower()
+        response = getattr(table, method)(**request)
+        if "Items" in response:
+            response["Items"] = [self._dump(item) for item in response["Items"]]
+            response["Count"] = len(response["Items"])
+        return {name: self._dump(value) if name in _ITEM_MEMBERS else value
+                for name, value in response.items()}
+
+    def _load(self, item):
+        return {name: self._deserializer.deserialize(value) for name, value in item.items()}
+
+    def _dump(self, item):
+        return {name: self._serializer.serialize(_decimals(value)) for name, value in item.items()}
+
+
+def _decimals(value):
+    # boto3 only serializes numbers as int or Decimal; seeded items may hold floats
+    if isinstance(value, float):
+        return decimal.Decimal(str(value))
+    if isinstance(value, dict):
+        return {name: _decimals(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_decimals(item) for item in value]
+    return value
+
+
+class LocalStack:
+    """
+    Everything install() created, so callers can seed data and read counters
+    """
+
+    def __init__(self, tables, lambda_client, kendra_client, http):
+        self.tables = tables
+        self.lambda_client = lambda_client
+        self.kendra_client = kendra_client
+        self.http = http
+
+    def reset_counters(self):
+        for table in self.tables.values():
+            table.reset_counters()
+        self.lambda_client.invokes.clear()
+        self.kendra_client.queries.clear()
+        self.http.reset_counters()
+
+    def counters(self):
+        counters = {}
+        for name, table in self.tables.items():
+            for operation, count in table.calls.items():
+                counters[f"dynamodb.{operation}"] = counters.get(f"dynamodb.{operation}", 0) + count
+        counters["dynamodb.bytes_read"] = sum(table.bytes_read for table in self.tables.values())
+        counters["dynamodb.bytes_written"] = sum(table.bytes_written for table in self.tables.values())
+        counters["lambda.invoke"] = len(self.lambda_client.invokes)
+        counters["kendra.query"] = len(self.kendra_client.queries)
+        for path, count in self.http.requests.items():
+            counters[f"http.{path.rstrip('/').rsplit('/', 1)[-1]}"] = count
+        return counters
+
+
+TABLE_KEYS = {
+    "zoom_mapping_table": ("user_id",),
+    "client_mapping_table": ("client_id",),
+    "zoom_user_mapping": ("user_id",),
+    "transcript_table": ("user_id", "chunk_no"),
+    "outbox_table": ("to_jid", "seq"),
+    "idempotency_table": ("idempotency_key",),
+}
+
+
+def install(dynamodb_latency=0.0, http_latency=0.0, lambda_latency=0.0, kendra_latency=0.0,
+            extra_tables=None, batch_translation=False, aws_endpoint=False):
+    """
+    Starts the local stand-ins, points the env at them and registers them in aws_helper.
+    batch_translation makes the translation stand-in accept batches. aws_endpoint
+    serves the AWS calls from the stub server instead, so aws_helper imports
+    boto3 and builds real clients, e.g. to time a cold start.
+    """
+    import aws_helper
+
+    http = StubHTTPServer(latency=http_latency).start()
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["zoom_oauth_url"] = http.url
+    os.environ["zoom_api_url"] = http.url
+    os.environ["haptik_api_url"] = http.url
+    os.environ.setdefault("ticketing_handler_arn", "local-ticketing")
+    os.environ.setdefault("translation_service_arn", "local-translation")
+    os.environ.setdefault("index_id", "00000000-0000-0000-0000-000000000000")
+    # One bot sends every benchmark message; Zoom's per-bot limit would dominate the timings
+    os.environ.setdefault("zoom_rate_per_second", "1000000")
+    os.environ.setdefault("zoom_burst", "1000000")
+
+    tables = {}
+    for env_name, key_names in dict(TABLE_KEYS, **(extra_tables or {})).items():
+        table_name = os.environ.setdefault(env_name, f"local-{env_name}")
+        tables[env_name] = FakeTable(table_name, key_names, latency=dynamodb_latency)
+
+    lambda_client = FakeLambdaClient(latency=lambda_latency, batch=batch_translation)
+    kendra_client = FakeKendraClient(latency=kendra_latency)
+    if aws_endpoint:
+        os.environ["AWS_ENDPOINT_URL"] = http.url
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "local")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "local")
+        http.aws = AWSProtocol(tables, lambda_client, kendra_client)
+    else:
+        for table in tables.values():
+            aws_helper.register_table(table.name, table)
+        aws_helper.register_client("lambda", lambda_client)
+        aws_helper.register_client("kendra", kendra_client)
+    return LocalStack(tables, lambda_client, kendra_client, http)
@@ -0,0 +1,136 @@
+"""
+Realistic webhook events, in the shape lambda_handler receives them, and the
+records they need in the mapping tables
+"""
+import itertools
+import uuid
+
+CLIENT_ID = "client-1"
+AUTH_USER = "auth-user-1"
+ZOOM_USER = "zoom-user-1"
+ZOOM_AUTH = "Basic bG9jYWw6bG9jYWw="
+ACCOUNT_ID = "local-account"
+
+_conversation_numbers = itertools.count(1)
+
+
+def seed_client(stack, client_id=CLIENT_ID, translation=False):
+    stack.tables["client_mapping_table"].seed({
+        "client_id": client_id,
+        "zoom_auth": ZOOM_AUTH,
+        "bot_business": "1",
+        "bot_client_id": "local-bot",
+        "bot_chat_auth": "local-chat-auth",
+        "is_translation": translation
+    })
+
+
+def seed_user(stack, auth_user, zoom_user, index):
+    # Maps auth_user to zoom_user and gives it a conversation with 40 transcript lines
+    stack.tables["zoom_user_mapping"].seed({"user_id": auth_user, "zoom_id": zoom_user})
+    stack.tables["zoom_mapping_table"].seed({
+        "user_id": zoom_user,
+        "robot_jid": "robot@xmpp.zoom.us",
+        "to_jid": f"user{index}@xmpp.zoom.us",
+        "account_id": ACCOUNT_ID,
+        "im_channel": "local-channel",
+        "agent_name": "jane doe",
+        "email": f"user{index}@example.com",
+        "latest_message": "reset password",
+        "chat_lines": [f"09:00:{second:02d} 01-01-2024 [BOT]: earlier message {second}"
+                       for second in range(40)]
+    })
+
+
+def seed(stack, users=1, translation=False):
+    """
+    Seeds the client record and `users` conversations (auth-user-N -> zoom-user-N)
+    """
+    seed_client(stack, translation=translation)
+    for index in range(1, users + 1):
+        seed_user(stack, f"auth-user-{index}", f"zoom-user-{index}", index)
+
+
+def seed_events(stack, events, translation=False):
+    """
+    Seeds a client record and a conversation for every client and user that
+    appears in recorded events, so any capture can be replayed locally
+    """
+    for client_id in {event.get("client_id") for event in events}:
+        seed_client(stack, client_id, translation)
+    users = sorted({event.get("user") for event in events if event.get("user")})
+    for index, user in enumerate(users, 1):
+        seed_user(stack, user, f"zoom-{user}", index)
+
+
+def _event(body, user=AUTH_USER):
+    # Messages carry Haptik's message id; the other events have none and are deduplicated
+    # by content. A retry reuses the event as is.
+    if isinstance(body.get("message"), dict):
+        body["message"]["id"] = uuid.uuid4().hex
+    return {"client_id": CLIENT_ID, "itsm": "servicenow", "user": user, "body": body}
+
+
+def message_text(user=AUTH_USER, text="Your ticket has been created", automated=True):
+    return _event({
+        "event_name": "message",
+        "agent": {"is_automated": automated, "name": "jane doe"},
+        "message": {"body": {"text": text, "type": "TEXT"}}
+    }, user)
+
+
+def message_button(user=AUTH_USER):
+    return _event({
+        "event_name": "message",
+        "agent": {"is_automated": False, "name": "jane doe"},
+        "message": {"body": {"text": "Here is the guide", "type": "BUTTON", "data": {"items": [
+            {"type": "APP_ACTION", "uri": "LINK", "actionable_text": "VPN guide",
+             "payload": {"url": "https://files.example.com/vpn.pdf"}},
+            {"type": "TEXT_ONLY", "actionable_text": "Yes", "payload": {"message": "yes"}},
+            {"type": "TEXT_ONLY", "actionable_text": "No", "payload": {"message": "no"}}
+        ]}}}
+    }, user)
+
+
+def message_carousel(user=AUTH_USER, images=5):
+    return _event({
+        "event_name": "message",
+        "agent": {"is_automated": False, "name": "jane doe"},
+        "message": {"body": {"text": "", "type": "CAROUSEL", "data": {"items": [
+            {"title": f"screenshot-{index}", "thumbnail": {"image": f"https://files.example.com/{index}.png"}}
+            for index in range(images)
+        ]}}}
+    }, user)
+
+
+def message_bot_break(user=AUTH_USER):
+    return _event({
+        "event_name": "message",
+        "agent": {"is_automated": True},
+        "message": {"body": {"text": "BOT BREAK", "type": "TEXT",
+                             "data": {"intents": ["Reset password", "VPN not working"]}}}
+    }, user)
+
+
+def chat_pinned(user=AUTH_USER):
+    return _event({"event_name": "chat_pinned", "agent": {"name": "jane doe"},
+                   "data": {"conversation_no": next(_conversation_numbers)}}, user)
+
+
+def conversation_complete(user=AUTH_USER):
+    return _event({
+        "event_name": "webhook_conversation_complete",
+        "agent": {"is_automated": False},
+        "user": {"user_name": "local-user"},
+        "data": {"conversation_no": next(_conversation_numbers)}
+    }, user)
+
+
+EVENTS = {
+    "message_text": message_text,
+    "message_button": message_button,
+    "message_carousel": message_carousel,
+    "message_bot_break": message_bot_break,
+    "chat_pinned": chat_pinned,
+    "conversation_complete": conversation_complete,
+}
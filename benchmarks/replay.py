@@ -0,0 +1,275 @@
+"""
+Replays recorded webhook traffic through lambda_handler against the local
+stand-ins at increasing concurrency (and optionally a target rate), and
+reports a throughput/latency curve.
+
+    python -m benchmarks.replay record traffic.jsonl --count 2000 --users 50
+    python -m benchmarks.replay run traffic.jsonl --concurrency 1,2,4,8,16
+    python -m benchmarks.replay run traffic.jsonl --concurrency 4 --rate 50,100,200
+    python -m benchmarks.replay run traffic.jsonl --processes --concurrency 1,4,8
+    python -m benchmarks.replay run traffic.jsonl --save-baseline benchmarks/baseline.json
+    python -m benchmarks.replay run traffic.jsonl --baseline benchmarks/baseline.json
+
+The input is JSONL, one event per line in the shape lambda_handler receives.
+Events of one user always go to the same worker, in file order. Threads share
+one warm container; --processes gives every worker its own container, the
+way concurrent Lambda invocations run. With a target rate, latency is taken
+from each event's scheduled start, so a backlog shows up as latency.
+
+With --baseline the run fails when a level's p95 or any per-event DynamoDB,
+HTTP, Lambda or Kendra call count is above the stored baseline.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPLAY_PERCENTILES = (50, 95, 99)
+# Relative share of each fixture in recorded traffic
+TRAFFIC_MIX = {
+    "message_text": 50,
+    "message_button": 15,
+    "message_carousel": 5,
+    "message_bot_break": 10,
+    "chat_pinned": 10,
+    "conversation_complete": 10,
+}
+
+
+def record(path, count, users, seed=0):
+    # Writes synthetic traffic built from the fixtures, for when no capture is at hand
+    from benchmarks import fixtures
+
+    rng = random.Random(seed)
+    names = list(TRAFFIC_MIX)
+    weights = [TRAFFIC_MIX[name] for name in names]
+    with open(path, "w") as output:
+        for _ in range(count):
+            event_type = rng.choices(names, weights)[0]
+            user = f"auth-user-{rng.randint(1, users)}"
+            output.write(json.dumps(fixtures.EVENTS[event_type](user=user)) + "\n")
+
+
+def load_events(path):
+    with open(path) as source:
+        return [json.loads(line) for line in source if line.strip()]
+
+
+def partition(events, workers):
+    # Splits (index, event) pairs across workers, keeping each user's events on one worker
+    shards = [[] for _ in range(workers)]
+    for index, event in enumerate(events):
+        user = str(event.get("user", index))
+        shards[zlib.crc32(user.encode()) % workers].append((index, event))
+    return shards
+
+
+def drive(lambda_function, shard, start_at, interval):
+    """
+    Runs a worker's events in order; with an interval, event i is due at
+    start_at + i * interval. Returns (durations_ms, errors, first start and
+    last finish as wall-clock times)
+    """
+    durations = []
+    errors = 0
+    begun = None
+    for index, event in shard:
+        scheduled = start_at + index * interval if interval else time.perf_counter()
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if begun is None:
+            begun = time.time()
+        try:
+            response = lambda_function.lambda_handler(event, None)
+            if isinstance(response, dict) and response.get("statusCode", 200) >= 400:
+                errors += 1
+        except Exception:
+            errors += 1
+        durations.append((time.perf_counter() - scheduled) * 1000)
+    return durations, errors, (begun or time.time(), time.time())
+
+
+def _install(events, translation, dedup=False):
+    os.environ.setdefault("metrics_enabled", "false")
+    # Every level replays the same events, which would all be duplicates after the first
+    os.environ.setdefault("idempotency_enabled", "true" if dedup else "false")
+    from benchmarks import fakes, fixtures
+
+    stack = fakes.install()
+    fixtures.seed_events(stack, events, translation)
+    import lambda_function
+    logging.disable(logging.CRITICAL)
+    return stack, lambda_function
+
+
+def _process_worker(shard, events, translation, dedup, start_wall, interval):
+    # One container: its own stand-ins, seeded for the whole capture
+    sys.path.insert(0, ROOT)
+    stack, lambda_function = _install(events, translation, dedup)
+    try:
+        start_at = time.perf_counter() + max(start_wall - time.time(), 0)
+        return drive(lambda_function, shard, start_at, interval) + (stack.counters(),)
+    finally:
+        stack.http.stop()
+
+
+def run_threads(stack, lambda_function, shards, interval):
+    results = [None] * len(shards)
+    start_at = time.perf_counter() + 0.05
+
+    def work(position):
+        results[position] = drive(lambda_function, shards[position], start_at, interval)
+
+    threads = [threading.Thread(target=work, args=(position,)) for position in range(len(shards))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [result + (None,) for result in results]
+
+
+def run_level(events, workers, rate, processes, translation, dedup=False, stack=None, lambda_function=None):
+    """
+    Replays every event with `workers` workers and returns the level's summary
+    """
+    from benchmarks.end_to_end import summarize
+
+    interval = 1.0 / rate if rate else 0.0
+    shards = [shard for shard in partition(events, workers) if shard]
+    if processes:
+        start_wall = time.time() + 2.0
+        with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+            futures = [pool.submit(_process_worker, shard, events, translation, dedup, start_wall, interval)
+                       for shard in shards]
+            results = [future.result() for future in futures]
+        counters = {}
+        for *_, shard_counters in results:
+            for name, count in shard_counters.items():
+                counters[name] = counters.get(name, 0) + count
+    else:
+        stack.reset_counters()
+        results = run_threads(stack, lambda_function, shards, interval)
+        counters = stack.counters()
+    elapsed = max(span[1] for _, _, span, _ in results) - min(span[0] for _, _, span, _ in results)
+
+    durations = [duration for shard_durations, *_ in results for duration in shard_durations]
+    return {
+        "workers": workers,
+        "target_rate": rate,
+        "throughput": round(len(durations) / elapsed, 1) if elapsed > 0 else 0.0,
+        "errors": sum(errors for _, errors, *_ in results),
+        "latency": summarize(durations, REPLAY_PERCENTILES),
+        "calls": {name: round(count / len(events), 3) for name, count in counters.items()},
+    }
+
+
+def _gated_calls(calls):
+    return {name: count for name, count in calls.items() if "bytes" not in name}
+
+
+def check_baseline(results, baseline, tolerance, slack_ms):
+    """
+    Returns the regressions of results against a stored baseline
+    """
+    regressions = []
+    for level, result in results.items():
+        expected = baseline.get(level)
+        if expected is None:
+            continue
+        p95, allowed = result["latency"]["p95_ms"], expected["latency"]["p95_ms"] * (1 + tolerance) + slack_ms
+        if p95 > allowed:
+            regressions.append(f"{level}: p95 {p95:.2f}ms is over {allowed:.2f}ms")
+        expected_calls = _gated_calls(expected["calls"])
+        for name, count in _gated_calls(result["calls"]).items():
+            if count > expected_calls.get(name, 0) + 1e-6:
+                regressions.append(f"{level}: {name} {count:g}/event is over {expected_calls.get(name, 0):g}")
+    return regressions
+
+
+def print_curve(results):
+    print(f"{'level':<16}{'workers':>8}{'rate':>8}{'events/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for level, result in results.items():
+        latency = result["latency"]
+        print(f"{level:<16}{result['workers']:>8}{result['target_rate'] or '-':>8}{result['throughput']:>10.1f}"
+              f"{latency['p50_ms']:>10.2f}{latency['p95_ms']:>10.2f}{latency['p99_ms']:>10.2f}{result['errors']:>8}")
+    last = next(reversed(results.values()), None)
+    if last:
+        calls = ", ".join(f"{name}={count:g}" for name, count in sorted(last["calls"].items()) if count)
+        print(f"per event: {calls}")
+
+
+def _numbers(text, kind):
+    return [kind(value) for value in text.split(",") if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="write synthetic traffic from the fixtures")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--count", type=int, default=1000)
+    record_parser.add_argument("--users", type=int, default=20)
+    record_parser.add_argument("--seed", type=int, default=0)
+    run_parser = commands.add_parser("run", help="replay traffic and report the curve")
+    run_parser.add_argument("path")
+    run_parser.add_argument("--concurrency", default="1,2,4,8", help="comma separated worker counts")
+    run_parser.add_argument("--rate", default="", help="comma separated target events per second")
+    run_parser.add_argument("--processes", action="store_true", help="one process (container) per worker")
+    run_parser.add_argument("--translation", action="store_true")
+    run_parser.add_argument("--dedup", action="store_true",
+                            help="keep idempotency on; repeated levels then see duplicates only")
+    run_parser.add_argument("--json", action="store_true")
+    run_parser.add_argument("--save-baseline", help="write the results to this file")
+    run_parser.add_argument("--baseline", help="fail on regressions against this file")
+    run_parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p95 increase")
+    run_parser.add_argument("--slack-ms", type=float, default=1.0, help="allowed absolute p95 increase")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, ROOT)
+    if args.command == "record":
+        record(args.path, args.count, args.users, args.seed)
+        return 0
+
+    events = load_events(args.path)
+    stack = lambda_function = None
+    if not args.processes:
+        stack, lambda_function = _install(events, args.translation, args.dedup)
+
+    results = {}
+    try:
+        for workers in _numbers(args.concurrency, int):
+            for rate in _numbers(args.rate, float) or [None]:
+                level = f"c{workers}" + (f"-r{rate:g}" if rate else "")
+                results[level] = run_level(events, workers, rate, args.processes, args.translation,
+                                           args.dedup, stack, lambda_function)
+    finally:
+        if stack:
+            stack.http.stop()
+            logging.disable(logging.NOTSET)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_curve(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressions = check_baseline(results, json.load(source), args.tolerance, args.slack_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
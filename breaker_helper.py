@@ -0,0 +1,180 @@
+import collections
+import logging
+import os
+import threading
+import time
+import metrics_helper
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Calls slower than this count against a breaker like errors do
+SLOW_CALL_MS = {
+    "kendra": 1500,
+    "translation": 1500,
+    "haptik": 3000,
+}
+
+
+def _setting(name, key, default):
+    # <name>_breaker_<key> overrides breaker_<key> for one dependency
+    return float(os.environ.get(f"{name}_breaker_{key}", os.environ.get(f"breaker_{key}", default)))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class _Call:
+    __slots__ = ("failed",)
+
+    def __init__(self):
+        self.failed = False
+
+
+class CircuitBreaker:
+    """
+    Error-rate and latency circuit breaker of one dependency, kept for the
+    life of the warm container.
+
+    Calls of the last window_seconds are kept. Once there are min_calls of
+    them and the share of errors or of slow calls reaches its rate, the
+    breaker opens: calls fail fast with CircuitOpenError for open_seconds.
+    Then a single probe call is let through (half open); it closes the
+    breaker when it succeeds and opens it again when it doesn't.
+    """
+
+    def __init__(self, name, window_seconds=None, min_calls=None, error_rate=None, slow_call_ms=None,
+                 slow_rate=None, open_seconds=None):
+        self.name = name
+        self.window_seconds = window_seconds or _setting(name, "window_seconds", 60)
+        self.min_calls = int(min_calls or _setting(name, "min_calls", 10))
+        self.error_rate = error_rate or _setting(name, "error_rate", 0.5)
+        self.slow_call_ms = slow_call_ms or _setting(name, "slow_call_ms", SLOW_CALL_MS.get(name, 2000))
+        self.slow_rate = slow_rate or _setting(name, "slow_rate", 0.8)
+        self.open_seconds = open_seconds or _setting(name, "open_seconds", 30)
+        self.state = CLOSED
+        self._calls = collections.deque()
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        # Caller holds the lock
+        logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        metrics_helper.increment(f"breaker.{self.name}.{state}")
+
+    def _trim(self, now):
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+
+    def _admit(self):
+        """
+        Returns (allowed, probe) for a call about to start. An open breaker lets
+        one probe through once open_seconds have passed; only guard() admits
+        calls, so every probe's result reaches record().
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True, False
+            if self.state == OPEN and time.monotonic() >= self._opened_at + self.open_seconds:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True, True
+        metrics_helper.increment(f"breaker.{self.name}.rejected")
+        return False, False
+
+    def record(self, duration_ms, failed, probe=False):
+        """
+        Records a finished call. Only the probe's result closes or reopens a
+        half-open breaker; calls that started while it was closed and finish
+        later are ignored once it has opened.
+        """
+        now = time.monotonic()
+        slow = duration_ms >= self.slow_call_ms
+        with self._lock:
+            if probe:
+                self._probing = False
+                if self.state != HALF_OPEN:
+                    return
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._calls.clear()
+                    self._set_state(CLOSED)
+                return
+            if self.state != CLOSED:
+                return
+            self._calls.append((now, failed, slow))
+            self._trim(now)
+            count = len(self._calls)
+            if count < self.min_calls:
+                return
+            errors = sum(1 for _, call_failed, _ in self._calls if call_failed)
+            slow_calls = sum(1 for _, _, call_slow in self._calls if call_slow)
+            if errors / count >= self.error_rate or slow_calls / count >= self.slow_rate:
+                self._open(now)
+
+    def _open(self, now):
+        self._opened_at = now
+        self._set_state(OPEN)
+
+    def guard(self):
+        """
+        Context manager around one call. Raises CircuitOpenError instead of
+        entering when the breaker is open. An exception, or setting .failed
+        (e.g. for a 5xx response), counts the call as an error.
+        """
+        return _Guard(self)
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return {"state": self.state, "calls": len(self._calls),
+                    "errors": sum(1 for _, failed, _ in self._calls if failed),
+                    "slow": sum(1 for _, _, slow in self._calls if slow)}
+
+
+class _Guard:
+    __slots__ = ("breaker", "call", "_start", "_probe")
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    def __enter__(self):
+        allowed, self._probe = self.breaker._admit()
+        if not allowed:
+            raise CircuitOpenError(f"Circuit breaker {self.breaker.name} is open")
+        self.call = _Call()
+        self._start = time.perf_counter()
+        return self.call
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration_ms = (time.perf_counter() - self._start) * 1000
+        self.breaker.record(duration_ms, exc_type is not None or self.call.failed, self._probe)
+        return False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    # Returns the breaker of the dependency, created on first use
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def get_breaker_stats():
+    return {name: breaker.stats() for name, breaker in _breakers.items()}
@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import metrics_helper
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Stored for keys whose lookup found nothing, so repeated misses skip the backend too.
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a TTL.
+
+    Instances are meant to live at module level so they survive warm invocations.
+    Missing values are cached as MISSING with their own (usually shorter) TTL.
+    """
+
+    def __init__(self, name, max_size=None, ttl=None, negative_ttl=None):
+        self.name = name
+        self.max_size = max_size or int(os.environ.get("cache_max_size", 1024))
+        self.ttl = ttl if ttl is not None else float(os.environ.get("cache_ttl_seconds", 300))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else \
+            float(os.environ.get("negative_cache_ttl_seconds", 60))
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value (possibly MISSING) or default when absent/expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                metrics_helper.increment(f"cache.{self.name}.misses")
+                return default
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                metrics_helper.increment(f"cache.{self.name}.misses")
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics_helper.increment(f"cache.{self.name}.hits")
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is MISSING else self.ttl
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value or calls loader(key) and caches its result.
+        A loader returning None is cached as a miss and None is returned.
+        """
+        value = self.get(key, None)
+        if value is None:
+            value = loader(key)
+            self.set(key, MISSING if value is None else value)
+        return None if value is MISSING else value
+
+    def invalidate(self, key=None):
+        # Drops one key, or every entry when no key is given
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        return {"name": self.name, "hits": self.hits, "misses": self.misses, "size": len(self._entries)}
@@ -0,0 +1,112 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+MAX_WORKERS = int(os.environ.get("fan_out_max_workers", 8))
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name="fan-out"):
+    """
+    Returns the named shared thread pool, created on first use and kept for warm invocations.
+    Steps and fan-out jobs use separate pools so a step can fan out without starving itself.
+    """
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = _executors[name] = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                                                 thread_name_prefix=name)
+    return executor
+
+
+def fan_out(func, jobs, pool="fan-out"):
+    """
+    Calls func(*args) for every args tuple in jobs on the named shared pool.
+
+    A failing job doesn't stop the others. Returns (results, failures) where
+    results follow the job order (None for failed jobs) and failures is a list
+    of (args, exception).
+    """
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    failures = []
+    if len(jobs) == 1:
+        try:
+            results[0] = func(*jobs[0])
+        except Exception as ex:
+            failures.append((jobs[0], ex))
+        return results, failures
+
+    # Each job runs in a copy of the caller's context so metrics land in the right invocation
+    executor = get_executor(pool)
+    futures = [executor.submit(contextvars.copy_context().run, func, *args) for args in jobs]
+    for index, future in enumerate(futures):
+        try:
+            results[index] = future.result()
+        except Exception as ex:
+            failures.append((jobs[index], ex))
+    return results, failures
+
+
+def _timed(func, kwargs):
+    start = time.perf_counter()
+    try:
+        return True, func(**kwargs), time.perf_counter() - start
+    except Exception as ex:
+        return False, ex, time.perf_counter() - start
+
+
+def run_steps(steps, flow="steps"):
+    """
+    Runs a small dependency graph of steps concurrently.
+
+    steps maps a step name to (func, depends_on). Each func is started as soon
+    as every step in depends_on is done and receives their results as keyword
+    arguments. Returns the results by step name and logs per-step timings.
+    If a step raises, its dependents are skipped and the first exception is
+    raised once the running steps have finished.
+    """
+    start = time.perf_counter()
+    executor = get_executor("steps")
+    pending = dict(steps)
+    running = {}
+    results = {}
+    timings = {}
+    error = None
+    while pending or running:
+        if error is None:
+            for name, (func, depends_on) in list(pending.items()):
+                if all(dependency in results for dependency in depends_on):
+                    del pending[name]
+                    kwargs = {dependency: results[dependency] for dependency in depends_on}
+                    running[executor.submit(contextvars.copy_context().run,
+                                           _timed, func, kwargs)] = name
+        if not running:
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            ok, value, elapsed = future.result()
+            timings[name] = round(elapsed * 1000, 1)
+            if ok:
+                results[name] = value
+            else:
+                logger.error(f"Step {name} of {flow} failed: {value}")
+                error = error or value
+    timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(f"Step timings (ms) for {flow}: {timings}")
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f"Unresolvable step dependencies in {flow}: {sorted(pending)}")
+    return results
@@ -0,0 +1,208 @@
+import itertools
+import logging
+import threading
+import metrics_helper
+import outbox_helper
+from transcript_helper import INCOMPLETE_ATTRIBUTE, OFFSET_ATTRIBUTE, format_line, get_transcript_store
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class ConversationContext:
+    """
+    Per-invocation view of a user's record in the zoom mapping table.
+
+    The item is read once on first access and served from memory afterwards.
+    Updates and transcript lines are collected and written back by flush()
+    in a single update_item at the end of the invocation. In outbox mode the
+    same update reserves the sequence numbers of the queued Zoom messages.
+    """
+
+    def __init__(self, user_id, table, transcript_store=None, client_id=None):
+        self.user_id = user_id
+        self.client_id = client_id
+        self.transcript_store = transcript_store or get_transcript_store()
+        self.reads = 0
+        self.writes = 0
+        self._table = table
+        self._item = None
+        self._exists = False
+        self._updates = {}
+        self._transcript_lines = []
+        self._outbox = []
+        # While coalescing, messages are buffered instead of sent; see take_buffered
+        self.coalescing = False
+        self._buffered = []
+        self._resolved_lines = None
+        self._lock = threading.RLock()
+
+    @property
+    def item(self):
+        if self._item is None:
+            with self._lock:
+                if self._item is None:
+                    with metrics_helper.span("dynamodb.get_item"):
+                        response = self._table.get_item(Key={"user_id": self.user_id}, **self._projection())
+                    self.reads += 1
+                    self._item = response.get("Item", {})
+                    self._exists = "Item" in response
+        return self._item
+
+    def _projection(self):
+        # Stores that keep the transcript out of the item only need these attributes
+        attributes = getattr(self.transcript_store, "projection", None)
+        if not attributes:
+            return {}
+        names = {f"#p{index}": attribute for index, attribute in enumerate(attributes)}
+        return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+    def get(self, attribute, default=None):
+        return self.item.get(attribute, default)
+
+    @property
+    def found(self):
+        # True when the user has a record in the table
+        self.item
+        return self._exists
+
+    @property
+    def robot_jid(self):
+        return self.get("robot_jid", "")
+
+    @property
+    def to_jid(self):
+        return self.get("to_jid", "")
+
+    @property
+    def account_id(self):
+        return self.get("account_id", "")
+
+    @property
+    def im_channel(self):
+        return self.get("im_channel")
+
+    @property
+    def agent_name(self):
+        return self.get("agent_name")
+
+    @property
+    def email(self):
+        return self.get("email")
+
+    def set(self, attribute, value):
+        # Records an attribute update to be written on flush
+        with self._lock:
+            self.item[attribute] = value
+            self._updates[attribute] = value
+
+    def add_transcript_line(self, message, agent_name):
+        line = format_line(message, agent_name)
+        with self._lock:
+            self._transcript_lines.append(line)
+
+    def enqueue_message(self, message):
+        # Queues an outbox_helper.outbox_message, numbered and stored on flush
+        with self._lock:
+            self._outbox.append(message)
+
+    def buffer_message(self, message):
+        with self._lock:
+            self._buffered.append(message)
+
+    def take_buffered(self):
+        # Returns and forgets the messages buffered while coalescing
+        with self._lock:
+            buffered, self._buffered = self._buffered, []
+        return buffered
+
+    def conversation_lines(self, include_incomplete=False):
+        """
+        Stored transcript lines of the current conversation, i.e. since the last
+        resolution. None when there are none, or when the record is flagged
+        with transcript_incomplete (unless include_incomplete is set). A record
+        without transcript_offset has never been resolved here, so where its
+        conversation starts is unknown: it is treated as incomplete, and has
+        no lines to offer even with include_incomplete.
+        """
+        if not self.found:
+            return None
+        offset = self.get(OFFSET_ATTRIBUTE)
+        if offset is None or (self.get(INCOMPLETE_ATTRIBUTE) and not include_incomplete):
+            return None
+        offset = int(offset)
+        lines = list(itertools.islice(self.transcript_store.read_lines(self.item), offset, None))
+        with self._lock:
+            self._resolved_lines = offset + len(lines)
+        return lines or None
+
+    def mark_resolved(self):
+        # Starts the next conversation after every line stored so far, pending ones included.
+        # Users without a record have no transcript, and none is created for them.
+        if not self.found:
+            return
+        with self._lock:
+            if self._resolved_lines is None:
+                self._resolved_lines = sum(1 for _ in self.transcript_store.read_lines(self.item))
+            self.set(OFFSET_ATTRIBUTE, self._resolved_lines + len(self._transcript_lines))
+            self.set(INCOMPLETE_ATTRIBUTE, False)
+
+    def flush(self):
+        """
+        Writes all pending updates and transcript lines in one update_item
+        """
+        with self._lock:
+            if not self._updates and not self._transcript_lines and not self._outbox:
+                return
+            names = {}
+            values = {}
+            assignments = []
+            for index, (attribute, value) in enumerate(self._updates.items()):
+                names[f"#a{index}"] = attribute
+                values[f":v{index}"] = value
+                assignments.append(f"#a{index}=:v{index}")
+            if self._transcript_lines:
+                assignment, transcript_names, transcript_values = \
+                    self.transcript_store.update_clause(self.item, self._transcript_lines)
+                assignments.append(assignment)
+                names.update(transcript_names)
+                values.update(transcript_values)
+            if self._outbox:
+                assignments.append("#os=if_not_exists(#os, :os_zero) + :os_n")
+                names["#os"] = outbox_helper.SEQUENCE_ATTRIBUTE
+                values.update({":os_zero": 0, ":os_n": len(self._outbox)})
+            try:
+                with metrics_helper.span("dynamodb.update_item"):
+                    response = self._table.update_item(Key={"user_id": self.user_id},
+                                                       UpdateExpression="set " + ", ".join(assignments),
+                                                       ExpressionAttributeNames=names,
+                                                       ExpressionAttributeValues=values,
+                                                       ReturnValues="UPDATED_NEW" if self._outbox else "NONE")
+            except Exception:
+                if self._transcript_lines:
+                    self._mark_incomplete()
+                raise
+            self.writes += 1
+            if self._outbox:
+                outbox_helper.store(self._outbox, response["Attributes"][outbox_helper.SEQUENCE_ATTRIBUTE])
+                self._outbox.clear()
+            self.item.update(self._updates)
+            self._updates.clear()
+            self._transcript_lines.clear()
+            after_flush = getattr(self.transcript_store, "after_flush", None)
+            if after_flush:
+                after_flush(self.user_id, self.item)
+
+    def _mark_incomplete(self):
+        # Best effort after a failed flush: its transcript lines are lost
+        try:
+            with metrics_helper.span("dynamodb.update_item"):
+                self._table.update_item(Key={"user_id": self.user_id},
+                                        UpdateExpression="set #ti=:ti",
+                                        ExpressionAttributeNames={"#ti": INCOMPLETE_ATTRIBUTE},
+                                        ExpressionAttributeValues={":ti": True})
+        except Exception as ex:
+            logger.error(f"Couldn't flag the transcript of user: {self.user_id} as incomplete: {ex}")
+
+    def stats(self):
+        return {"user_id": self.user_id, "reads": self.reads, "writes": self.writes}
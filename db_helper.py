@@ -1,26 +1,70 @@
-import boto3
 import logging
 import os
+from cache_helper import TTLCache
+import metrics_helper
+from aws_helper import get_table
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-db_service = boto3.resource("dynamodb")
+client_config_cache = TTLCache("client_config")
+reverse_mapping_cache = TTLCache("reverse_mapping")
+
+
+def _load_client_config(client_id):
+    logger.info(f"checking the client info for client: {client_id}")
+    with metrics_helper.span("dynamodb.get_item"):
+        response = get_table(os.environ.get("client_mapping_table")).get_item(Key={"client_id": client_id})
+    logger.debug("Response of client_id mapping: %s", response)
+    if "Item" not in response:
+        return None
+    item = response.get("Item", {})
+    creds = {
+        "zoom_auth": item.get("zoom_auth"),
+        "bot_business": item.get("bot_business"),
+        "bot_client_id": item.get("bot_client_id"),
+        "bot_chat_auth": item.get("bot_chat_auth")
+    }
+    return {"creds": creds, "is_translation": item.get("is_translation", "")}
+
+
+def get_client_config(client_id):
+    """
+    Returns the creds and is_translation flag of the client from one record fetch.
+    Cached across warm invocations; None when the client is not configured.
+    """
+    return client_config_cache.get_or_load(client_id, _load_client_config)
 
-client_mapping_table = db_service.Table(os.environ.get("client_mapping_table"))
 
 def get_creds(client_id):
     # Returns the configured zoom channel
-    logger.info(f"checking the client info for client: {client_id}")
-    response = client_mapping_table.get_item(Key={"client_id": client_id})
-    logger.debug(f"Response of client_id mapping: {response}")
-    creds = {}
-    if "Item" in response:
-        creds["zoom_auth"] = response.get("Item", {}).get("zoom_auth")
-        creds["bot_business"] = response.get("Item", {}).get("bot_business")
-        creds["bot_client_id"] = response.get("Item", {}).get("bot_client_id")
-        creds["bot_chat_auth"] = response.get("Item", {}).get("bot_chat_auth")
-        return creds
-    else:
-        logger.error(f"Creds not found for client_id: {client_id}")
-        
\ No newline at end of file
+    config = get_client_config(client_id)
+    if config:
+        return config["creds"]
+    logger.error(f"Creds not found for client_id: {client_id}")
+
+
+def _load_zoom_id(user_id):
+    with metrics_helper.span("dynamodb.get_item"):
+        response = get_table(os.environ.get("zoom_user_mapping")).get_item(Key={"user_id": user_id})
+    return response.get("Item", {}).get("zoom_id") if "Item" in response else None
+
+
+def get_zoom_id(user_id):
+    """
+    Returns the zoom user id mapped to the auth user id, or None when unmapped.
+    Missing users are cached too so retries for them don't hit the table.
+    """
+    return reverse_mapping_cache.get_or_load(user_id, _load_zoom_id)
+
+
+def invalidate_caches(client_id=None, user_id=None):
+    # Drops cached client/user lookups; with no arguments clears both caches
+    if client_id is None and user_id is None:
+        client_config_cache.invalidate()
+        reverse_mapping_cache.invalidate()
+        return
+    if client_id is not None:
+        client_config_cache.invalidate(client_id)
+    if user_id is not None:
+        reverse_mapping_cache.invalidate(user_id)
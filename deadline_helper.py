@@ -0,0 +1,111 @@
+import contextvars
+import logging
+import os
+import time
+import metrics_helper
+from requests.exceptions import Timeout
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Kept back from every budget so a late call still leaves time to flush the
+# conversation, release claims and write the metrics before Lambda kills us
+RESERVE_SECONDS = float(os.environ.get("deadline_reserve_ms", 1500)) / 1000
+# Used when there is no Lambda context, e.g. benchmarks and scripts
+DEFAULT_SECONDS = float(os.environ.get("deadline_default_ms", 30000)) / 1000
+
+# Longest each dependency call may take, further capped by the time left
+BUDGETS = {
+    "zoom": float(os.environ.get("zoom_timeout_seconds", 10)),
+    "zoom_token": float(os.environ.get("zoom_token_timeout_seconds", 5)),
+    "haptik": float(os.environ.get("haptik_timeout_seconds", 10)),
+    "kendra": float(os.environ.get("kendra_timeout_seconds", 3)),
+    "translation": float(os.environ.get("translation_timeout_seconds", 3)),
+}
+# Optional steps (Kendra, translation) are skipped when less than this is left
+MIN_OPTIONAL_SECONDS = float(os.environ.get("deadline_min_optional_ms", 1000)) / 1000
+
+timeout_stats = {}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    When the current invocation has to be done by, as a monotonic time
+    """
+
+    def __init__(self, seconds):
+        self.at = time.monotonic() + seconds
+
+    @classmethod
+    def from_context(cls, context):
+        get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+        return cls(get_remaining() / 1000 if get_remaining else DEFAULT_SECONDS)
+
+    @property
+    def usable_until(self):
+        # The monotonic time calls must finish by, reserve excluded
+        return self.at - RESERVE_SECONDS
+
+    def remaining(self):
+        # Seconds left for dependency calls
+        return max(0.0, self.usable_until - time.monotonic())
+
+    def budget(self, dependency):
+        """
+        Seconds the next call to dependency may take: its own limit capped by
+        the time left. Raises DeadlineExceeded when nothing is left.
+        """
+        seconds = min(BUDGETS.get(dependency, DEFAULT_SECONDS), self.remaining())
+        if seconds <= 0:
+            raise DeadlineExceeded(f"No time left to call {dependency}")
+        return seconds
+
+    def allows_optional(self, dependency):
+        # False when an optional call should be skipped to protect the rest of the invocation
+        if self.remaining() >= MIN_OPTIONAL_SECONDS:
+            return True
+        metrics_helper.increment(f"{dependency}.skipped")
+        logger.info(f"Skipping {dependency}, only {self.remaining():.2f}s left")
+        return False
+
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def start(context):
+    """
+    Starts the deadline of an invocation from the Lambda context's remaining
+    time. fan_out and run_steps copy the context, so their jobs see it too.
+    """
+    deadline = Deadline.from_context(context)
+    _deadline.set(deadline)
+    return deadline
+
+
+def current():
+    # The invocation's deadline, or a fresh default one outside of an invocation
+    deadline = _deadline.get()
+    if deadline is None:
+        return Deadline(DEFAULT_SECONDS + RESERVE_SECONDS)
+    return deadline
+
+
+def is_timeout(ex):
+    # True for the deadline running out and for HTTP or boto3 timeouts
+    if isinstance(ex, (DeadlineExceeded, Timeout)):
+        return True
+    from botocore.exceptions import ConnectTimeoutError, ReadTimeoutError
+    return isinstance(ex, (ConnectTimeoutError, ReadTimeoutError))
+
+
+def count_timeout(dependency):
+    timeout_stats[dependency] = timeout_stats.get(dependency, 0) + 1
+    metrics_helper.increment(f"{dependency}.timeouts")
+
+
+def get_timeout_stats():
+    return dict(timeout_stats)
@@ -0,0 +1,144 @@
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Haptik event_name -> event type, used for routing, logs and metrics
+EVENT_NAMES = {
+    "webhook_conversation_complete": "resolution",
+    "message": "message",
+    "chat_pinned": "pinned",
+}
+# Checked in order when the event_name isn't an exact match
+_EVENT_NAME_PARTS = (
+    ("webhook_conversation_complete", "resolution"),
+    ("message", "message"),
+    ("chat_pinned", "pinned"),
+)
+
+
+def get_event_type(event_name):
+    # Maps the Haptik event_name to resolution, message, pinned or unsupported
+    event_type = EVENT_NAMES.get(event_name)
+    if event_type:
+        return event_type
+    for part, event_type in _EVENT_NAME_PARTS:
+        if part in event_name:
+            return event_type
+    return "unsupported"
+
+
+def _dict(value):
+    return value if isinstance(value, dict) else {}
+
+
+class ButtonItem:
+    """
+    One item of a BUTTON message: a link (APP_ACTION/LINK) or a quick reply (TEXT_ONLY)
+    """
+    __slots__ = ("actionable_text", "url", "message", "is_link", "is_text")
+
+    def __init__(self, item):
+        item_type = (item.get("type") or "").lower()
+        payload = _dict(item.get("payload"))
+        self.actionable_text = item.get("actionable_text", "")
+        self.url = payload.get("url", "")
+        self.message = payload.get("message", "")
+        self.is_link = item_type == "app_action" and (item.get("uri") or "").lower() == "link"
+        self.is_text = item_type == "text_only"
+
+    @property
+    def file_type(self):
+        # pdf or docx when the link is a document the ticket should get, else None
+        if ".pdf" in self.url:
+            return "pdf"
+        if ".docx" in self.url:
+            return "docx"
+        return None
+
+
+class CarouselItem:
+    __slots__ = ("title", "image")
+
+    def __init__(self, item):
+        self.title = item.get("title", "")
+        self.image = _dict(item.get("thumbnail")).get("image", "")
+
+
+class WebhookEvent:
+    """
+    Fields every webhook event carries. `raw` is the untouched body for logging,
+    `event_id` Haptik's id of the delivery when the payload has one.
+    """
+    __slots__ = ("event_type", "event_name", "event_id", "client_id", "itsm", "user", "is_automated", "raw")
+
+    def __init__(self, event, body, event_type):
+        agent = _dict(body.get("agent"))
+        self.event_type = event_type
+        self.event_name = body.get("event_name", "")
+        self.event_id = body.get("event_id") or _dict(body.get("message")).get("id") or body.get("message_id")
+        self.client_id = event.get("client_id")
+        self.itsm = event.get("itsm")
+        self.user = event.get("user")
+        self.is_automated = agent.get("is_automated")
+        self.raw = body
+
+
+class MessageEvent(WebhookEvent):
+    __slots__ = ("text", "message_type", "intents", "buttons", "carousel")
+
+    def __init__(self, event, body, event_type):
+        super().__init__(event, body, event_type)
+        message_body = _dict(_dict(body.get("message")).get("body"))
+        data = _dict(message_body.get("data"))
+        self.text = message_body.get("text", "")
+        self.message_type = message_body.get("type", "")
+        self.intents = data.get("intents") or []
+        items = [item for item in data.get("items") or [] if isinstance(item, dict)]
+        self.buttons = [ButtonItem(item) for item in items] if "BUTTON" in self.message_type else []
+        self.carousel = [CarouselItem(item) for item in items] if "CAROUSEL" in self.message_type else []
+
+    @property
+    def is_bot_break(self):
+        return "BOT BREAK" in self.text or bool(self.intents)
+
+    @property
+    def is_button(self):
+        return "BUTTON" in self.message_type
+
+    @property
+    def is_carousel(self):
+        return "CAROUSEL" in self.message_type
+
+
+class PinnedEvent(WebhookEvent):
+    __slots__ = ("agent_name",)
+
+    def __init__(self, event, body, event_type):
+        super().__init__(event, body, event_type)
+        self.agent_name = _dict(body.get("agent")).get("name")
+
+
+class ResolutionEvent(WebhookEvent):
+    __slots__ = ("user_name", "conversation_number")
+
+    def __init__(self, event, body, event_type):
+        super().__init__(event, body, event_type)
+        self.user_name = _dict(body.get("user")).get("user_name")
+        self.conversation_number = _dict(body.get("data")).get("conversation_no")
+
+
+EVENT_CLASSES = {
+    "message": MessageEvent,
+    "pinned": PinnedEvent,
+    "resolution": ResolutionEvent,
+}
+
+
+def parse_event(event):
+    """
+    Parses a lambda_handler event in one pass into its typed event object
+    """
+    body = _dict(event.get("body"))
+    event_type = get_event_type(body.get("event_name") or "")
+    return EVENT_CLASSES.get(event_type, WebhookEvent)(event, body, event_type)
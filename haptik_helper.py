@@ -1,13 +1,20 @@
-import requests
+import breaker_helper
+import deadline_helper
+import http_helper
 import logging
+import os
+import metrics_helper
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+HAPTIK_CHAT_HISTORY_URL = os.environ.get("haptik_api_url", "https://staging.hellohaptik.com") + \
+    "/integration/external/v1.0/get_chat_history/"
+
 def get_chat_transcripts(creds, user_name, conversation_number):
-    # Returns the chat transcript Text
+    # Returns the chat transcript Text. Raises breaker_helper.CircuitOpenError while Haptik's circuit is open
 
-    url = "https://staging.hellohaptik.com/integration/external/v1.0/get_chat_history/"
+    url = HAPTIK_CHAT_HISTORY_URL
     parameters = {
         "user_name": user_name,
         "business_id": int(creds["bot_business"]),
@@ -19,8 +26,26 @@ def get_chat_transcripts(creds, user_name, conversation_number):
         "client-id": creds["bot_client_id"],
         "Authorization": creds["bot_chat_auth"]
     }
-    response = requests.request("GET", url, params=parameters, headers=headers)
-    logging.debug(f"Response of the Chat history API:\n{response.text}")
+    # Budgeted, retries included, by haptik_timeout_seconds and the invocation's deadline
+    deadline = deadline_helper.current()
+    try:
+        deadline.budget("haptik")
+    except deadline_helper.DeadlineExceeded:
+        deadline_helper.count_timeout("haptik")
+        raise
+    with breaker_helper.get_breaker("haptik").guard() as guarded, \
+            metrics_helper.span("haptik.chat_history") as call:
+        try:
+            response = http_helper.request("GET", url, params=parameters, headers=headers,
+                                           deadline=deadline, dependency="haptik")
+        except Exception as ex:
+            if deadline_helper.is_timeout(ex):
+                deadline_helper.count_timeout("haptik")
+            raise
+        call.status = response.status_code
+        guarded.failed = response.status_code >= 500
+        call.size = len(response.content)
+    logger.debug("Response of the Chat history API:\n%s", response.text)
     if response.status_code == 200:
         return response.json().get("chat_text")
-    logging.error(f"Chat history API return unhandled status_code:\n{response.status_code}")
\ No newline at end of file
+    logger.error(f"Chat history API return unhandled status_code: {response.status_code}")
\ No newline at end of file
@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CONNECT_TIMEOUT = float(os.environ.get("http_connect_timeout", 3.05))
+READ_TIMEOUT = float(os.environ.get("http_read_timeout", 10))
+POOL_CONNECTIONS = int(os.environ.get("http_pool_connections", 4))
+POOL_MAXSIZE = int(os.environ.get("http_pool_maxsize", 10))
+MAX_RETRIES = int(os.environ.get("http_max_retries", 2))
+BACKOFF_FACTOR = float(os.environ.get("http_backoff_factor", 0.3))
+RETRY_STATUSES = (502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _build_session(retries=True):
+    # Only idempotent methods are retried; a POST that reached Zoom must not be replayed.
+    retry = Retry(total=MAX_RETRIES,
+                  connect=MAX_RETRIES,
+                  read=MAX_RETRIES,
+                  backoff_factor=BACKOFF_FACTOR,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                          pool_maxsize=POOL_MAXSIZE,
+                          max_retries=retry if retries else 0)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url, retries=True):
+    """
+    Returns the keep-alive Session for the url's host, creating it on first use.
+    Sessions without retries are for calls that retry within a deadline themselves.
+    """
+    key = (urlsplit(url).netloc, retries)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                logger.info(f"Creating pooled HTTP session for host: {key[0]}")
+                session = _sessions[key] = _build_session(retries)
+    return session
+
+
+def request(method, url, timeout=None, deadline=None, dependency=None, **kwargs):
+    """
+    Drop-in replacement for requests.request that reuses pooled connections
+    and always applies a (connect, read) timeout.
+
+    With a deadline (a deadline_helper.Deadline) the call is budgeted as a
+    whole: its attempts and backoffs share the dependency's budget out of the
+    time left, and are retried here instead of by urllib3.
+    """
+    if deadline is None:
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        return get_session(url).request(method, url, timeout=timeout, **kwargs)
+    call_until = time.monotonic() + deadline.budget(dependency)
+    session = get_session(url, retries=False)
+    idempotent = method.upper() in Retry.DEFAULT_ALLOWED_METHODS
+    attempt = 0
+    while True:
+        left = call_until - time.monotonic()
+        try:
+            response = session.request(method, url, timeout=(min(CONNECT_TIMEOUT, left), left), **kwargs)
+        except requests.exceptions.RequestException as ex:
+            # Only a request that never reached the server may be sent again when it isn't idempotent
+            retryable = isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)) \
+                if idempotent else isinstance(ex, requests.exceptions.ConnectTimeout)
+            if not retryable or not _backoff(attempt, call_until):
+                raise
+        else:
+            if not idempotent or response.status_code not in RETRY_STATUSES or not _backoff(attempt, call_until):
+                return response
+        attempt += 1
+
+
+def _backoff(attempt, call_until):
+    # Sleeps before the next attempt; False when retries are used up or the sleep doesn't fit the budget
+    if attempt >= MAX_RETRIES:
+        return False
+    wait = BACKOFF_FACTOR * (2 ** attempt)
+    if time.monotonic() + wait >= call_until:
+        return False
+    time.sleep(wait)
+    return True
+
+
+def close_sessions():
+    # Closes every pooled session, mostly useful for tests and benchmarks
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
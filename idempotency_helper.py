@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import deadline_helper
+import metrics_helper
+from aws_helper import get_table
+from cache_helper import TTLCache
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+IDEMPOTENCY_ENABLED = os.environ.get("idempotency_enabled", "true").lower() == "true"
+# How long an event id is remembered
+IDEMPOTENCY_TTL = int(os.environ.get("idempotency_ttl_seconds", 24 * 3600))
+# Events without an id are keyed on their content. The window is short so a
+# message that is legitimately sent twice ("ok", "ok") is not dropped.
+HASH_TTL = int(os.environ.get("idempotency_hash_ttl_seconds", 120))
+# A claim is in progress until complete(); it lapses this long after the
+# invocation's deadline, so a retry after a timeout or a killed container is processed
+IN_PROGRESS_GRACE = int(os.environ.get("idempotency_in_progress_grace_seconds", 5))
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+seen_events = TTLCache("idempotency", max_size=int(os.environ.get("idempotency_cache_max_size", 4096)),
+                       ttl=IDEMPOTENCY_TTL)
+dedup_stats = {"claimed": 0, "local_duplicates": 0, "shared_duplicates": 0}
+_claim_lock = threading.Lock()
+
+
+def _get_table():
+    table_name = os.environ.get("idempotency_table")
+    return get_table(table_name) if table_name else None
+
+
+def idempotency_key(event):
+    """
+    Returns the key of a parsed webhook event: its Haptik id when it has
+    one, else a hash of the client, user and body (see _key_ttl)
+    """
+    if event.event_id:
+        return f"id:{event.client_id}:{event.event_id}"
+    content = json.dumps([event.client_id, event.user, event.raw], sort_keys=True, default=str)
+    return f"sha256:{hashlib.sha256(content.encode()).hexdigest()}"
+
+
+def _in_progress_ttl():
+    deadline = deadline_helper.current()
+    return int(deadline.remaining() + deadline_helper.RESERVE_SECONDS) + IN_PROGRESS_GRACE
+
+
+def _claim_shared(key, ttl):
+    # Conditional put that only succeeds when no completed or in-progress claim is live
+    table = _get_table()
+    if table is None:
+        return True
+    now = int(time.time())
+    try:
+        with metrics_helper.span("dynamodb.put_item"):
+            table.put_item(Item={"idempotency_key": key, "status": IN_PROGRESS, "expires_at": now + ttl},
+                           ConditionExpression="attribute_not_exists(#k) OR #e < :now",
+                           ExpressionAttributeNames={"#k": "idempotency_key", "#e": "expires_at"},
+                           ExpressionAttributeValues={":now": now})
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def claim(event):
+    """
+    Returns the event's key when this is its first delivery, or None for a
+    duplicate that must be skipped. Checked in the warm container first,
+    then with a conditional put on the idempotency table (its expires_at is
+    meant to be the table's TTL attribute).
+
+    The claim is in progress, and only lives as long as the invocation, until
+    complete() keeps it for the key's full TTL. A delivery whose processing
+    never finished is therefore processed again by a later retry.
+    """
+    if not IDEMPOTENCY_ENABLED:
+        return ""
+    key = idempotency_key(event)
+    in_progress_ttl = _in_progress_ttl()
+    with _claim_lock:
+        if seen_events.get(key) is not None:
+            dedup_stats["local_duplicates"] += 1
+            metrics_helper.increment("idempotency.duplicates")
+            logger.info(f"Skipping duplicate delivery {key} seen by this container")
+            return None
+        seen_events.set(key, IN_PROGRESS, in_progress_ttl)
+    try:
+        claimed = _claim_shared(key, in_progress_ttl)
+    except Exception as ex:
+        # The webhook is more important than its dedup
+        logger.error(f"Couldn't check the idempotency table, processing {key}: {ex}")
+        claimed = True
+    if not claimed:
+        # The live claim belongs to another invocation; once it lapses a retry must reach the table again
+        seen_events.invalidate(key)
+        dedup_stats["shared_duplicates"] += 1
+        metrics_helper.increment("idempotency.duplicates")
+        logger.info(f"Skipping duplicate delivery {key}")
+        return None
+    dedup_stats["claimed"] += 1
+    metrics_helper.increment("idempotency.claimed")
+    return key
+
+
+def _key_ttl(key):
+    # How long a processed key is remembered
+    return HASH_TTL if key.startswith("sha256:") else IDEMPOTENCY_TTL
+
+
+def complete(key):
+    """
+    Marks a claimed key as processed, so deliveries are skipped for its full TTL
+    """
+    if not key:
+        return
+    ttl = _key_ttl(key)
+    seen_events.set(key, COMPLETED, ttl)
+    table = _get_table()
+    if table is None:
+        return
+    try:
+        with metrics_helper.span("dynamodb.update_item"):
+            table.update_item(Key={"idempotency_key": key},
+                              UpdateExpression="set #s=:s, #e=:e",
+                              ExpressionAttributeNames={"#s": "status", "#e": "expires_at"},
+                              ExpressionAttributeValues={":s": COMPLETED, ":e": int(time.time()) + ttl})
+    except Exception as ex:
+        # The in-progress claim still lapses; a retry after that is processed again
+        logger.error(f"Couldn't mark idempotency key {key} completed: {ex}")
+
+
+def release(key):
+    """
+    Forgets a claimed key after its processing failed, so Haptik's retry
+    is processed instead of skipped
+    """
+    if not key:
+        return
+    seen_events.invalidate(key)
+    table = _get_table()
+    if table is None:
+        return
+    try:
+        with metrics_helper.span("dynamodb.delete_item"):
+            table.delete_item(Key={"idempotency_key": key})
+    except Exception as ex:
+        logger.error(f"Couldn't release idempotency key {key}: {ex}")
+
+
+def get_dedup_stats():
+    duplicates = dedup_stats["local_duplicates"] + dedup_stats["shared_duplicates"]
+    total = duplicates + dedup_stats["claimed"]
+    return dict(dedup_stats, hit_rate=round(duplicates / total, 4) if total else 0.0)
@@ -1,17 +1,142 @@
-import json
-import boto3
 import os
 import logging
+import re
+import time
+from cache_helper import TTLCache
+import breaker_helper
+import deadline_helper
+import metrics_helper
+from aws_helper import get_client, get_table
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)
 
-kendra = boto3.client('kendra')
+KENDRA_CACHE_TTL = int(os.environ.get("kendra_cache_ttl_seconds", 3600))
 
-def search_kendra(query):
+kendra_cache = TTLCache("kendra", max_size=int(os.environ.get("kendra_cache_max_size", 512)),
+                        ttl=KENDRA_CACHE_TTL)
+# Local hits are also emitted as cache.kendra.hits; the other outcomes as kendra.<outcome>,
+# since cache.kendra.misses counts a shared-tier hit as a miss
+kendra_cache_stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "bypassed": 0}
+# Sent instead of an answer when Kendra is skipped or timed out; the message's buttons still offer an agent
+KENDRA_FALLBACK_MESSAGE = os.environ.get(
+    "kendra_fallback_message", "I couldn't look that up right now, kindly try again or talk to an agent")
+
+
+def _get_cache_table():
+    # The shared cache tier is optional and only used when kendra_cache_table is set
+    table_name = os.environ.get("kendra_cache_table")
+    return get_table(table_name) if table_name else None
+
+
+def normalize_query(query):
+    # Lowercases the query and drops punctuation/extra spaces so phrasings share a cache entry
+    return " ".join(re.sub(r"[^\w\s]", " ", (query or "").lower()).split())
+
+
+def _cache_bypassed():
+    return os.environ.get("kendra_cache_bypass", "").lower() in ("1", "true", "yes")
+
+
+def _get_shared(cache_key):
+    kendra_cache_table = _get_cache_table()
+    if kendra_cache_table is None:
+        return None
+    try:
+        with metrics_helper.span("dynamodb.get_item"):
+            item = kendra_cache_table.get_item(Key={"cache_key": cache_key}).get("Item")
+    except Exception as ex:
+        logger.error(f"Couldn't read the shared Kendra cache: {ex}")
+        return None
+    # DynamoDB TTL deletes lazily, so expired items can still be returned
+    if item and int(item.get("expires_at", 0)) > time.time():
+        return item.get("message", ""), item.get("link", "")
+    return None
+
+
+def _put_shared(cache_key, result):
+    kendra_cache_table = _get_cache_table()
+    if kendra_cache_table is None:
+        return
+    try:
+        with metrics_helper.span("dynamodb.put_item"):
+            kendra_cache_table.put_item(Item={
+                "cache_key": cache_key,
+                "message": result[0],
+                "link": result[1],
+                "expires_at": int(time.time()) + KENDRA_CACHE_TTL
+            })
+    except Exception as ex:
+        logger.error(f"Couldn't write the shared Kendra cache: {ex}")
+
+
+def search_kendra(query, bypass_cache=False):
+    """
+    Returns (message, link) for the query, served from the in-process cache,
+    then the shared DynamoDB cache (kendra_cache_table), then Kendra itself
+    """
     index_id = os.environ.get('index_id')
-    response=kendra.query(QueryText = query, IndexId = index_id)
-    logger.debug(f"Kendra Response for the query: {query} is:\n{response}")
+    if bypass_cache or _cache_bypassed():
+        kendra_cache_stats["bypassed"] += 1
+        metrics_helper.increment("kendra.bypassed")
+        return _query_within_deadline(query, index_id) or (KENDRA_FALLBACK_MESSAGE, "")
+
+    cache_key = f"{index_id}:{normalize_query(query)}"
+    result = kendra_cache.get(cache_key)
+    if result is not None:
+        kendra_cache_stats["local_hits"] += 1
+        return result
+
+    result = _get_shared(cache_key)
+    if result is not None:
+        kendra_cache_stats["shared_hits"] += 1
+        metrics_helper.increment("kendra.shared_hits")
+    else:
+        kendra_cache_stats["misses"] += 1
+        metrics_helper.increment("kendra.misses")
+        result = _query_within_deadline(query, index_id)
+        if result is None:
+            return KENDRA_FALLBACK_MESSAGE, ""
+        _put_shared(cache_key, result)
+    kendra_cache.set(cache_key, result)
+    logger.debug("Kendra cache stats: %s", kendra_cache_stats)
+    return result
+
+
+def _query_within_deadline(query, index_id):
+    """
+    Queries Kendra unless the invocation is short on time or Kendra's circuit
+    is open. Returns None instead of a result when the query is skipped or
+    times out.
+    """
+    deadline = deadline_helper.current()
+    if not deadline.allows_optional("kendra"):
+        return None
+    try:
+        deadline.budget("kendra")
+        with breaker_helper.get_breaker("kendra").guard():
+            return query_kendra(query, index_id)
+    except breaker_helper.CircuitOpenError:
+        logger.info("Kendra's circuit is open, replying without it")
+        return None
+    except Exception as ex:
+        if not deadline_helper.is_timeout(ex):
+            raise
+        deadline_helper.count_timeout("kendra")
+        logger.error(f"Kendra timed out, replying without it: {ex}")
+        return None
+
+
+def get_cache_stats():
+    lookups = sum(kendra_cache_stats[key] for key in ("local_hits", "shared_hits", "misses"))
+    hits = kendra_cache_stats["local_hits"] + kendra_cache_stats["shared_hits"]
+    return dict(kendra_cache_stats, hit_rate=round(hits / lookups, 3) if lookups else 0.0)
+
+
+@metrics_helper.timed("kendra.query")
+def query_kendra(query, index_id):
+    response=get_client('kendra', budget='kendra').query(QueryText = query, IndexId = index_id)
+    logger.debug("Kendra Response for the query: %s is:\n%s", query, response)
     answer = ""
     link = ""
     for query_result in response['ResultItems']:
@@ -29,5 +154,5 @@ def search_kendra(query):
             message = " ".join(document_text.split())
     else:
         message  = " ".join(answer.split())
-        
-    return message, link
\ No newline at end of file
+
+    return message, link
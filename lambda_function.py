@@ -1,68 +1,235 @@
 import json
 import logging
 import os
-import boto3
-from datetime import datetime
-from db_helper import get_creds
-from zoom_helper import send_message_to_zoom, send_message_with_button_to_zoom
+from db_helper import get_client_config, get_zoom_id
+from zoom_helper import (send_message_to_zoom, send_message_with_button_to_zoom,
+                         build_message_payload, build_button_payload, merge_payloads, post_chat_message)
 from haptik_helper import get_chat_transcripts
-from translation_helper import handle_message_translation
+from breaker_helper import CircuitOpenError
+from translation_helper import handle_message_translation, handle_batch_translation
+from translation_helper import batch_supported as translation_batch_supported
 from profiler import profile
 from kendra_helper import search_kendra
+from conversation_helper import ConversationContext
+from event_helper import get_event_type, parse_event
+from concurrency_helper import fan_out, run_steps
+import deadline_helper
+import metrics_helper
+import outbox_helper
+import idempotency_helper
+import log_helper
+from log_helper import VERBOSE
+from aws_helper import get_client, get_table
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
+log_helper.configure()
 
-lambda_client = boto3.client("lambda")
+# Where the resolution chat_history comes from: "haptik", or "local" for the stored
+# transcript with Haptik as the fallback when it is missing or flagged incomplete
+RESOLUTION_TRANSCRIPT_SOURCE = os.environ.get("resolution_transcript_source", "haptik").lower()
+# SQS batches only: message events of one conversation sent within this many
+# milliseconds of the first are handled together and their Zoom messages merged. 0 is off.
+COALESCE_WINDOW_MS = int(os.environ.get("coalesce_window_ms", 0))
 
-db_service = boto3.resource("dynamodb")
-user_mapping_table = db_service.Table(os.environ.get('zoom_mapping_table'))
-client_mapping_table = db_service.Table(os.environ.get('client_mapping_table'))
-reverse_mapping_table = db_service.Table(os.environ.get('zoom_user_mapping'))
 
 @profile
 def lambda_handler(event, context):
     """
     Analyzes the event and sends the message to user in ZOOM
     """
-    client_id = event.get("client_id")
-    itsm = event.get("itsm")
-    user_id = event.get("user")
-    payload = event.get("body")
-    logger.info(f"Incoming Payload:   {payload}")
+    return handle_event(event, context)
+
+
+@profile
+def batch_handler(event, context):
+    """
+    Processes an SQS batch whose record bodies are lambda_handler events.
+
+    Records are grouped by user so each conversation is handled in order,
+    while different conversations run concurrently. Once a record fails, the
+    rest of its conversation is reported as failed too so that SQS retries
+    them in order. Returns the failed records as batchItemFailures.
+    """
+    failed = []
+    conversations = {}
+    for record in event.get("Records", []):
+        try:
+            body = json.loads(record["body"])
+        except (KeyError, TypeError, ValueError) as ex:
+            logger.error(f"Couldn't parse SQS record {record.get('messageId')}: {ex}")
+            failed.append(record.get("messageId"))
+            continue
+        sent_ms = int(record.get("attributes", {}).get("SentTimestamp", 0))
+        conversations.setdefault(body.get("user"), []).append((record["messageId"], body, sent_ms))
+
+    jobs = [(records, context) for records in conversations.values()]
+    results, failures = fan_out(process_conversation_records, jobs, pool="batch")
+    for result in results:
+        failed.extend(result or [])
+    for (records, _), ex in failures:
+        logger.error(f"Couldn't process conversation records: {ex}")
+        failed.extend(message_id for message_id, *_ in records)
+    logger.info(f"Processed {len(event.get('Records', []))} records, {len(failed)} failed")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
+
+
+def process_conversation_records(records, context):
+    # Handles one conversation's records in order, returns the message ids left unprocessed
+    index = 0
+    for group in coalesce_records(records):
+        try:
+            if len(group) > 1:
+                handle_event_group([event for _, event, _ in group], context)
+            else:
+                handle_event(group[0][1], context)
+        except Exception:
+            logger.exception(f"Failed to process SQS record {group[0][0]}")
+            return [pending_id for pending_id, *_ in records[index:]]
+        index += len(group)
+    return []
+
+
+def coalesce_records(records):
+    """
+    Splits a conversation's (message_id, event, sent_ms) records into groups:
+    runs of message events of one client sent within COALESCE_WINDOW_MS of
+    the run's first one, and every other record on its own
+    """
+    groups = []
+    for record in records:
+        _, event, sent_ms = record
+        body = event.get("body") or {}
+        is_message = get_event_type(body.get("event_name") or "") == "message"
+        current = groups[-1] if groups else None
+        if (COALESCE_WINDOW_MS > 0 and is_message and current and current[0][3]
+                and current[0][1].get("client_id") == event.get("client_id")
+                and sent_ms - current[0][2] <= COALESCE_WINDOW_MS):
+            current.append(record + (True,))
+        else:
+            groups.append([record + (is_message,)])
+    return [[record[:3] for record in group] for group in groups]
+
+
+@profile
+def drain_handler(event, context):
+    """
+    Sends the Zoom messages queued in outbox mode, in order for each to_jid.
+
+    Triggered by the outbox table's stream (INSERT records name the to_jids to
+    drain) or by a schedule with any other event, which sweeps every to_jid
+    with queued messages. Different to_jids are drained concurrently.
+    """
+    records = event.get("Records") if isinstance(event, dict) else None
+    to_jids = outbox_helper.stream_conversations(records) if records else outbox_helper.pending_conversations()
+    metrics_helper.start_invocation(event_type="drain")
+    deadline_helper.start(context)
+    try:
+        results, failures = fan_out(outbox_helper.drain_conversation, [(to_jid,) for to_jid in to_jids],
+                                    pool="drain")
+        for (to_jid,), ex in failures:
+            logger.error(f"Couldn't drain the outbox of {to_jid}: {ex}")
+        logger.info(f"Drained {sum(results)} messages for {len(to_jids)} conversations, "
+                    f"{len(failures)} failed: {outbox_helper.drain_stats}")
+        return {"to_jids": len(to_jids), "sent": sum(results), "failed": len(failures)}
+    finally:
+        metrics_helper.flush()
+
+
+def handle_event(event, context):
+    # Runs one webhook event with its own log fields and metrics
+    return handle_event_group([event], context)
+
+
+def handle_event_group(events, context):
+    """
+    Runs webhook events of one conversation with shared log fields and metrics.
+    More than one event is coalesced, see process_events.
+    """
+    webhook_events = [parse_event(event) for event in events]
+    first = webhook_events[0]
+    log_helper.start_event(event_type=first.event_type, client_id=first.client_id,
+                           request_id=getattr(context, "aws_request_id", None),
+                           coalesced=len(webhook_events) if len(webhook_events) > 1 else None)
+    metrics_helper.start_invocation(event_type=first.event_type, client_id=first.client_id)
+    # Every dependency call below is budgeted out of the time Lambda gives this invocation
+    deadline_helper.start(context)
+    try:
+        # Haptik retries on timeout; a retry of an event already taken is skipped before any other call
+        claimed = []
+        for webhook_event in webhook_events:
+            idempotency_key = idempotency_helper.claim(webhook_event)
+            if idempotency_key is not None:
+                claimed.append((idempotency_key, webhook_event))
+        if not claimed:
+            return {
+                'statusCode': 200,
+                'body': json.dumps('Duplicate event')
+            }
+        try:
+            if len(claimed) == 1:
+                response = process_event(claimed[0][1])
+            else:
+                response = process_events([webhook_event for _, webhook_event in claimed])
+        except Exception:
+            for idempotency_key, _ in claimed:
+                idempotency_helper.release(idempotency_key)
+            raise
+        for idempotency_key, _ in claimed:
+            idempotency_helper.complete(idempotency_key)
+        return response
+    finally:
+        metrics_helper.flush()
+
+
+def process_event(event):
+    # event is the parsed WebhookEvent, see event_helper.parse_event
+    return process_events([event])
+
+
+def process_events(events):
+    """
+    Handles parsed events of one user with one conversation record. Several
+    (message) events are coalesced: their Zoom messages are merged and sent
+    after the last one, and everything is written back in one update.
+    """
+    event = events[0]
+    client_id = event.client_id
+    user_id = event.user
+    logger.info("Incoming Payload: %s", event.raw, extra=VERBOSE)
     
-    mapping_response = reverse_mapping_table.get_item(Key={"user_id": user_id})
-    if "Item" in mapping_response:
-        user_id = mapping_response.get("Item", {}).get("zoom_id")
-    else:
+    zoom_id = get_zoom_id(user_id)
+    if zoom_id is None:
         logger.error(
             f"Couldn't find the conversation_id for the given auth_id: {user_id}")
         return
+    user_id = zoom_id
     logger.info(f"USER ID:   {user_id}")
-    creds = get_creds(client_id)
-
-    event_name = payload.get('event_name', "")
-    is_automated = payload.get("agent", {}).get("is_automated")
-    
-    user_response = client_mapping_table.get_item(Key={"client_id": client_id})
-    if "Item" in user_response:
-        is_translation = user_response.get("Item", {}).get("is_translation", "")
+    conversation = ConversationContext(user_id, get_table(os.environ.get('zoom_mapping_table')),
+                                       client_id=client_id)
+    client_config = get_client_config(client_id)
+    if client_config:
+        creds = client_config["creds"]
+        is_translation = client_config["is_translation"]
     else:
-        logger.info(f"Items not found for the client:   {client_id}")
-
-    if 'webhook_conversation_complete' in event_name:
-        logger.info("Received Conversation completed event")
-        handle_resolution_event(is_translation, creds, payload, user_id,
-                                is_automated, itsm, client_id)
-    elif "message" in event_name:
-        logger.info("Received Message event")
-        handle_message_event(is_translation, creds, payload, user_id,
-                             is_automated, itsm, client_id)
-    elif "chat_pinned" in event_name:
-        logger.info("Received Chat Pinned event")
-        handle_pinned_event(is_translation, creds, payload, user_id)
-    else:
-        logger.info(f"Received Unsupported event: {event_name}")
+        logger.error(f"Items not found for the client:   {client_id}")
+        creds = None
+        is_translation = ""
+
+    conversation.coalescing = len(events) > 1
+    try:
+        for event in events:
+            handler = EVENT_HANDLERS.get(event.event_type)
+            if handler:
+                logger.info(f"Received {event.event_type} event: {event.event_name}")
+                handler(is_translation, creds, event, conversation)
+            else:
+                logger.info(f"Received Unsupported event: {event.event_name}")
+        if conversation.coalescing:
+            deliver_coalesced(conversation, creds, len(events))
+    finally:
+        conversation.flush()
+        logger.info(f"Conversation DB usage: {conversation.stats()}")
 
     return {
         'statusCode': 200,
@@ -70,74 +237,81 @@ def lambda_handler(event, context):
     }
     
 
-def handle_pinned_event(is_translation, creds, payload, user_id):
+def handle_pinned_event(is_translation, creds, event, conversation):
     """
     Posts a message in the chat window that a user has entered the conversation
     """
     try:
-        agent_name = payload.get("agent", {}).get("name").title()
+        agent_name = event.agent_name.title()
     except AttributeError:
         agent_name = "IT Agent"
     message = f"----- *{agent_name} has entered the conversation* -----"
 
-    if is_translation:
-        logger.info("is_translation is True. Translation function is called")
-        message = handle_message_translation(message, user_id)
+    user_id = conversation.user_id
+
+    def translate_message():
+        if is_translation:
+            logger.info("is_translation is True. Translation function is called")
+            return handle_message_translation(message, user_id)
+        return message
+
+    # Translation runs while the conversation record is being read
+    message = run_steps({
+        "message": (translate_message, ()),
+        "conversation_item": (lambda: conversation.item, ()),
+    }, "pinned")["message"]
     # data = {
     #     "channel": user_id.split("_")[1],
     #     "text": message
     # }
-    response = user_mapping_table.get_item(Key={"user_id": user_id})
+    robot_jid = conversation.robot_jid
+    account_id = conversation.account_id
+    to_jid = conversation.to_jid
 
-    if "Item" in response:
-        im_channel = response.get("Item", {}).get("im_channel")
-        robot_jid = response.get("Item", {}).get("robot_jid", "")
-        account_id = response.get("Item", {}).get("account_id", "")
-        to_jid = response.get("Item", {}).get("to_jid", "")
+    if conversation.found:
+        im_channel = conversation.im_channel
         if im_channel:
             logger.info("Found IM channel ID for sending the message as agent")
-            response = send_message_to_zoom(creds, robot_jid, account_id, to_jid, message, True, agent_name)
-            store_message_in_DB(message, user_id, agent_name)
+            response = deliver_message(conversation, creds, robot_jid, account_id, to_jid, message, True, agent_name)
+            store_message_in_DB(message, conversation, agent_name)
         else:
             logger.info("IM channel ID doesn't exist for agent chat")
-            response = send_message_to_zoom(creds, robot_jid, account_id, to_jid, message, False, "")
-            store_message_in_DB(message, user_id, "BOT")
-        user_mapping_table.update_item(
-            Key={"user_id": user_id},
-            UpdateExpression="set agent_name=:a",
-            ExpressionAttributeValues={
-                ":a": agent_name
-            })
+            response = deliver_message(conversation, creds, robot_jid, account_id, to_jid, message, False, "")
+            store_message_in_DB(message, conversation, "BOT")
+        conversation.set("agent_name", agent_name)
     else:
         logger.error(f"Couldn't find the user:{user_id} in DB")
-        response = send_message_to_zoom(creds, robot_jid, account_id,
-                                        to_jid, message, False, "")
+        response = deliver_message(conversation, creds, robot_jid, account_id,
+                                   to_jid, message, False, "")
 
-        store_message_in_DB(message, user_id, "BOT")
+        store_message_in_DB(message, conversation, "BOT")
 
 
-def handle_message_event(is_translation, creds, payload, user_id, is_automated, itsm, client_id):
+def handle_message_event(is_translation, creds, event, conversation):
     # Handles incoming message event
     logger.info("Handling Message event")
-    message = payload.get("message", {}).get("body", {}).get("text", "")
-    message_type = payload.get("message", {}).get("body", {}).get("type", "")
+    message = event.text
+    is_automated = event.is_automated
+    itsm = event.itsm
+    client_id = event.client_id
     agent_name = "IT Agent"
-    response = user_mapping_table.get_item(Key={"user_id": user_id})
-    email = response.get("Item", {}).get("email")
-    robot_jid = response.get("Item", {}).get("robot_jid", "")
-    account_id = response.get("Item", {}).get("account_id", "")
-    to_jid = response.get("Item", {}).get("to_jid", "")
-    # user_name = response.get("Item", {}).get("user_name", "")
-    # user_jid = response.get("Item", {}).get("user_jid", "")
-    query = response.get("Item", {}).get("latest_message")
+    user_id = conversation.user_id
+    email = conversation.email
+    robot_jid = conversation.robot_jid
+    account_id = conversation.account_id
+    to_jid = conversation.to_jid
+    # user_name = conversation.get("user_name", "")
+    # user_jid = conversation.get("user_jid", "")
+    query = conversation.get("latest_message")
     
     item_list = []
     link_list = []
-    logger.info(response)
-    if "Item" in response:
+    attachment_jobs = []
+    logger.info("Conversation record: %s", conversation.item, extra=VERBOSE)
+    if conversation.found:
         try:
-            im_channel = response.get("Item", {}).get("im_channel")
-            agent_name = response.get("Item", {}).get("agent_name").title()
+            im_channel = conversation.im_channel
+            agent_name = conversation.agent_name.title()
         except AttributeError:
             agent_name = "IT Agent"
     else:
@@ -147,7 +321,7 @@ def handle_message_event(is_translation, creds, payload, user_id, is_automated,
     is_link = False
     is_text = False
     
-    if 'BOT BREAK' in message or payload.get("message", {}).get("body", {}).get("data", {}).get("intents"):
+    if event.is_bot_break:
         is_text = True
         item_json = {
                    "text":"Talk to an Agent 💬",
@@ -155,65 +329,40 @@ def handle_message_event(is_translation, creds, payload, user_id, is_automated,
                    "style":"Default"
                 }
         item_list.append(item_json)
-        disambiguation_list = payload.get("message", {}).get("body", {}).get("data", {}).get("intents", [])
-        for Item in disambiguation_list:
+        for Item in event.intents:
             item_json = {
                        "text":f"{Item} 💬",
                        "value":Item,
                        "style":"Default"
                     }
             item_list.append(item_json)
-        return handle_kendra_search(item_list, query, creds, user_id, agent_name, im_channel, is_text, robot_jid, account_id, to_jid)
-
-    if 'BUTTON' in message_type:
-        message_url_items = payload.get("message", {}).get(
-            "body", {}).get("data", {}).get("items", [{}])
-        for Item in message_url_items:
-            thumb_url = Item.get("payload", {}).get("url", "")
-            actionable_text = Item.get("actionable_text", "")
-            uri = Item.get("uri", "")
-            item_type = Item.get("type", "")
-            item_message = Item.get("payload", {}).get("message", "")
-            is_agent = bool(im_channel) if not is_automated else False
-            if item_type.lower() == "app_action" and uri.lower() == "link":
+        return handle_kendra_search(item_list, query, creds, conversation, agent_name, im_channel, is_text, robot_jid, account_id, to_jid)
+
+    if event.is_button:
+        is_agent = bool(im_channel) if not is_automated else False
+        for button in event.buttons:
+            if button.is_link:
                 is_link = True
-                if ".pdf" in thumb_url or ".docx" in thumb_url:
-                    if is_agent:
-                        item_json = {
-                               "type":"message",
-                               "text":f"{actionable_text} 📎",
-                               "link":thumb_url
-                            }
-                        link_list.append(item_json)
-                        store_message_in_DB("ATTACHMENT", user_id, agent_name)
-                    else:
-                        item_json = {
-                               "type":"message",
-                               "text":f"{actionable_text} 📎",
-                               "link":thumb_url
-                            }
-                        link_list.append(item_json)
-                        store_message_in_DB("ATTACHMENT", user_id, "BOT")
-                    if ".pdf" in thumb_url:
-                        file_type = "pdf"
-                    else:
-                        file_type = "docx"
-                    ticket_attachment_invoke(file_type, itsm, user_id, client_id, email, actionable_text, thumb_url)
-                else:
-                    item_json = {
-                           "type":"message",
-                           "text":f"{actionable_text} 📎",
-                           "link":thumb_url
-                        }
-                    link_list.append(item_json)
-            elif item_type.lower() == "text_only":
+                item_json = {
+                       "type":"message",
+                       "text":f"{button.actionable_text} 📎",
+                       "link":button.url
+                    }
+                link_list.append(item_json)
+                file_type = button.file_type
+                if file_type:
+                    store_message_in_DB("ATTACHMENT", conversation, agent_name if is_agent else "BOT")
+                    attachment_jobs.append((file_type, itsm, user_id, client_id, email,
+                                            button.actionable_text, button.url))
+            elif button.is_text:
                 is_text = True
                 item_json = {
-                       "text":f"{actionable_text} 💬",
-                       "value":item_message,
+                       "text":f"{button.actionable_text} 💬",
+                       "value":button.message,
                        "style":"Default"
                     }
                 item_list.append(item_json)
+        dispatch_ticket_attachments(attachment_jobs)
 
         if message:
             message = message
@@ -223,28 +372,27 @@ def handle_message_event(is_translation, creds, payload, user_id, is_automated,
         # if thumb_url:
         #     data = button_payload(user_id.split("_")[1], message, item_list)
 
-    if "CAROUSEL" in message_type:
+    if event.is_carousel:
         logger.info("Incoming Attachment Detected")
-        attachment_items = payload.get("message", {}).get(
-            "body", {}).get("data", {}).get("items", [])
         is_agent = bool(im_channel) if not is_automated else False
-        for files in attachment_items:
-            thumb_url = files.get("thumbnail", {}).get("image", "")
-            text = files.get("title", "")
+        for files in event.carousel:
+            thumb_url = files.image
+            text = files.title
             if is_agent:
                 # send_file_to_zoom(creds, im_channel, text,
                 #                   thumb_url, True, agent_name)
-                store_message_in_DB("IMAGE", user_id, agent_name)
+                store_message_in_DB("IMAGE", conversation, agent_name)
             else:
                 # send_file_to_zoom(creds, user_id.split("_")[1],
                 #                   text, thumb_url, False, "")
-                store_message_in_DB("IMAGE", user_id, "BOT")
-            ticket_attachment_invoke("png", itsm, user_id, client_id, email, text, thumb_url)
+                store_message_in_DB("IMAGE", conversation, "BOT")
+            attachment_jobs.append(("png", itsm, user_id, client_id, email, text, thumb_url))
+        dispatch_ticket_attachments(attachment_jobs)
         return
 
     if is_translation:
         logger.info("is_translation is True. Translation function is called")
-        message = handle_message_translation(message, user_id)
+        message = translate_message_with_buttons(message, item_list + link_list, user_id)
     if not is_automated:
         logger.info("Sending message as Agent")
         if im_channel:
@@ -252,100 +400,216 @@ def handle_message_event(is_translation, creds, payload, user_id, is_automated,
             # response = send_message_to_zoom(creds,user_id, robot_jid, account_id,
             #                                 to_jid, message, True, agent_name)
             if item_list or link_list:
-                response = send_message_with_button_to_zoom(link_list, is_link, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name)
+                response = deliver_message_with_button(conversation, link_list, is_link, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name, record_channel=not im_channel)
             else:
-                response = send_message_to_zoom(creds, robot_jid, account_id, 
-                                            to_jid, message, True, agent_name)
-            store_message_in_DB(message, user_id, agent_name)
+                response = deliver_message(conversation, creds, robot_jid, account_id, 
+                                            to_jid, message, True, agent_name, record_channel=not im_channel)
+            store_message_in_DB(message, conversation, agent_name)
         else:
             logger.info("IM channel ID doesn't exist for agent chat")
             # response = send_message_to_zoom(creds, user_id, robot_jid, account_id, 
             #                                 to_jid, message, False, "")
             if item_list or link_list:
-                response = send_message_with_button_to_zoom(link_list, is_link, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name)
+                response = deliver_message_with_button(conversation, link_list, is_link, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name, record_channel=not im_channel)
             else:
-                response = send_message_to_zoom(creds, robot_jid, account_id, 
-                                            to_jid, message, False, "")
-            store_message_in_DB(message, user_id, "BOT")
+                response = deliver_message(conversation, creds, robot_jid, account_id, 
+                                            to_jid, message, False, "", record_channel=not im_channel)
+            store_message_in_DB(message, conversation, "BOT")
     else:
         logger.info("Received Automated message sending in the DM as bot")
         # response = send_message_to_zoom(creds, user_id, robot_jid, account_id, 
         #                                     to_jid, message, False, "")
         if item_list or link_list:
-                response = send_message_with_button_to_zoom(link_list, is_link, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name)
+                response = deliver_message_with_button(conversation, link_list, is_link, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name, record_channel=not im_channel)
         else:
-            response = send_message_to_zoom(creds, robot_jid, account_id, to_jid, message, False, "")
-        store_message_in_DB(message, user_id, "BOT")
+            response = deliver_message(conversation, creds, robot_jid, account_id, to_jid, message, False, "", record_channel=not im_channel)
+        store_message_in_DB(message, conversation, "BOT")
 
     if not im_channel and response:
         logger.info(
             "IM Channel ID was not available adding it to the DB from response")
-        user_mapping_table.update_item(Key={"user_id": user_id},
-                                       UpdateExpression="set im_channel=:i",
-                                       ExpressionAttributeValues={
-                                           ":i": response.json().get("channel")
-        })
+        conversation.set("im_channel", response.json().get("channel"))
 
 
-def handle_resolution_event(is_translation, creds, payload, user_id, is_automated, itsm, client_id):
+def handle_resolution_event(is_translation, creds, event, conversation):
     # Handles webhook_conversation_complete event
-    user_name = payload.get("user", {}).get("user_name")
-    conversation_number = payload.get("data", {}).get("conversation_no")
+    user_id = conversation.user_id
+    user_name = event.user_name
+    conversation_number = event.conversation_number
+    is_automated = event.is_automated
+    itsm = event.itsm
+    client_id = event.client_id
+    message = "----- *This conversation is marked as completed* -----"
 
-    chat_text = get_chat_transcripts(creds, user_name, conversation_number)
-    logger.debug(chat_text)
+    use_local = RESOLUTION_TRANSCRIPT_SOURCE == "local"
 
-    response = user_mapping_table.get_item(Key={"user_id": user_id})
+    def local_chat_text(include_incomplete):
+        try:
+            lines = conversation.conversation_lines(include_incomplete=include_incomplete)
+        except Exception as ex:
+            logger.error(f"Couldn't read the local transcript: {ex}")
+            return None
+        return "\n".join(lines) if lines else None
 
-    if "Item" in response:
-        robot_jid = response.get("Item", {}).get("robot_jid", "")
-        account_id = response.get("Item", {}).get("account_id", "")
-        to_jid = response.get("Item", {}).get("to_jid", "")
-        
-    message = "----- *This conversation is marked as completed* -----"
-    
-    if is_translation:
-        logger.info("is_translation is True. Translation function is called")
-        message = handle_message_translation(message, user_id)
+    def haptik_chat_text():
+        try:
+            chat_text = get_chat_transcripts(creds, user_name, conversation_number)
+        except CircuitOpenError:
+            logger.info("Haptik's circuit is open")
+            chat_text = None
+        except Exception as ex:
+            logger.error(f"Chat history API failed: {ex}")
+            chat_text = None
+        logger.debug("Chat transcript from Haptik: %s", chat_text)
+        return chat_text
 
-    response = send_message_to_zoom(creds, robot_jid, account_id, to_jid, message, False, "")
-    store_message_in_DB(message, user_id, "BOT")
-    data = {
-        "itsm": itsm,
-        "payload": {
-            "client_id": client_id,
-            "source": "zoom",
-            "event": "TICKET_RESOLUTION",
-            "user": user_id,
-            "chat_history": chat_text,
-            "is_automated": is_automated
+    def fetch_chat_text(conversation_item=None):
+        # Never raises: the closing message may already be sent, so a failed
+        # fetch must not leave the resolution half done for Haptik to retry
+        if use_local:
+            chat_text = local_chat_text(include_incomplete=False)
+            if chat_text is not None:
+                metrics_helper.increment("resolution.local_transcript")
+                return chat_text
+            metrics_helper.increment("resolution.haptik_fallback")
+            logger.info("Local transcript is missing or incomplete, fetching it from Haptik")
+        chat_text = haptik_chat_text()
+        if chat_text is None:
+            metrics_helper.increment("resolution.local_fallback")
+            logger.info("No transcript from Haptik, using the local transcript")
+            chat_text = local_chat_text(include_incomplete=True)
+        return chat_text
+
+    def translate_message():
+        if is_translation:
+            logger.info("is_translation is True. Translation function is called")
+            return handle_message_translation(message, user_id)
+        return message
+
+    def send_closing_message(conversation_item, closing_message):
+        deliver_message(conversation, creds, conversation.robot_jid, conversation.account_id,
+                        conversation.to_jid, closing_message, False, "")
+        store_message_in_DB(closing_message, conversation, "BOT")
+
+    def invoke_ticketing(chat_text, send):
+        data = {
+            "itsm": itsm,
+            "payload": {
+                "client_id": client_id,
+                "source": "zoom",
+                "event": "TICKET_RESOLUTION",
+                "user": user_id,
+                "chat_history": chat_text,
+                "is_automated": is_automated
+            }
         }
-    }
-    logger.info(f"Data being passed to ticketing function is: {data}")
-    lambda_client.invoke(FunctionName=os.environ.get("ticketing_handler_arn"),
-                         InvocationType="Event",
-                         Payload=json.dumps(data))
-
-def store_message_in_DB(message, user_id, agent_name):
-    # Stores the Chat message in the DB as chat_transcript.
-    user_mapping_table = db_service.Table(os.environ.get('zoom_mapping_table'))
-    response = user_mapping_table.get_item(Key={"user_id": user_id})
-    if "Item" not in response:
-        logger.error(f"User: {user_id} not found in the Table")
+        logger.info("Data being passed to ticketing function is: %s", data, extra=VERBOSE)
+        invoke_ticketing_handler(data)
+
+    # The Haptik fetch and the closing message don't depend on each other.
+    # Ticketing waits for both, so it only runs once the closing message is
+    # sent. The local transcript needs the conversation record first.
+    run_steps({
+        "chat_text": (fetch_chat_text, ("conversation_item",) if use_local else ()),
+        "conversation_item": (lambda: conversation.item, ()),
+        "closing_message": (translate_message, ()),
+        "send": (send_closing_message, ("conversation_item", "closing_message")),
+        "ticketing": (invoke_ticketing, ("chat_text", "send")),
+    }, "resolution")
+    if use_local:
+        conversation.mark_resolved()
+
+
+# Event type (see event_helper.get_event_type) -> handler
+EVENT_HANDLERS = {
+    "resolution": handle_resolution_event,
+    "message": handle_message_event,
+    "pinned": handle_pinned_event,
+}
+
+
+def deliver_message(conversation, creds, robot_jid, account_id, to_jid, message, is_agent, agent_name,
+                    record_channel=False):
+    """
+    Sends a message to Zoom, or in outbox mode queues it with the conversation
+    for drain_handler and returns None. record_channel asks the drain to store
+    the IM channel from Zoom's response, as the direct path's caller does.
+    """
+    if not (conversation.coalescing or outbox_helper.is_enabled() and conversation.found):
+        return send_message_to_zoom(creds, robot_jid, account_id, to_jid, message, is_agent, agent_name)
+    data = build_message_payload(robot_jid, account_id, to_jid, message, is_agent, agent_name)
+    queue_message(conversation, data, "zoom.send_message", record_channel)
+
+def deliver_message_with_button(conversation, link_list, is_link, is_text, item_list, creds, robot_jid, account_id,
+                                to_jid, message, is_agent, agent_name, record_channel=False):
+    # deliver_message for messages with buttons
+    if not (conversation.coalescing or outbox_helper.is_enabled() and conversation.found):
+        return send_message_with_button_to_zoom(link_list, is_link, is_text, item_list, creds, robot_jid,
+                                                account_id, to_jid, message, is_agent, agent_name)
+    data = build_button_payload(link_list, is_link, is_text, item_list, robot_jid, account_id, to_jid, message)
+    queue_message(conversation, data, "zoom.send_message_with_button", record_channel)
+
+def queue_message(conversation, data, span_name, record_channel):
+    # Buffers the payload while coalescing, else queues it in the outbox
+    message = outbox_helper.outbox_message(conversation.client_id, conversation.user_id,
+                                           data, span_name, record_channel)
+    if conversation.coalescing:
+        conversation.buffer_message(message)
+    else:
+        conversation.enqueue_message(message)
+
+def deliver_coalesced(conversation, creds, event_count):
+    """
+    Merges the messages buffered for a group of events and delivers them,
+    through the outbox in outbox mode
+    """
+    buffered = conversation.take_buffered()
+    if not buffered:
         return
-    chat_transcript = response.get("Item", {}).get("chat_transcript")
-    formatted_time = datetime.now().strftime("%H:%M:%S %d-%m-%Y")
-    message = f"{formatted_time} [{agent_name}]: {message}"
-    if chat_transcript:
-        message = f"{chat_transcript}\n{message}"
-        
-    user_mapping_table.update_item(Key={"user_id": user_id},
-                                UpdateExpression="set chat_transcript=:i",
-                                ExpressionAttributeValues={
-                                    ":i": message
-                                })
+    conversation.coalescing = False
+    record_channel = any(message["record_channel"] for message in buffered)
+    merged = merge_payloads([message["data"] for message in buffered])
+    metrics_helper.increment("zoom.coalesced", len(buffered) - len(merged))
+    logger.info(f"Coalesced {len(buffered)} messages of {event_count} events into {len(merged)}")
+    for data in merged:
+        if outbox_helper.is_enabled() and conversation.found:
+            queue_message(conversation, data, "zoom.send_message_coalesced", record_channel)
+            record_channel = False
+            continue
+        try:
+            response = post_chat_message(creds, data.get("account_id", ""), data, "zoom.send_message_coalesced")
+        except Exception as ex:
+            logger.error(f"Encountered exception while sending coalesced message to zoom: {ex}")
+            continue
+        if response is None or response.status_code != 201:
+            logger.error(f"Coalesced message to zoom failed: {getattr(response, 'status_code', 'dropped')}")
+            continue
+        if record_channel:
+            conversation.set("im_channel", response.json().get("channel"))
+            record_channel = False
+
+def store_message_in_DB(message, conversation, agent_name):
+    # Queues the Chat message for the chat_transcript, written once when the invocation ends.
+    if not conversation.found:
+        logger.error(f"User: {conversation.user_id} not found in the Table")
+        return
+    conversation.add_transcript_line(message, agent_name)
     return
 
+def translate_message_with_buttons(message, button_list, user_id):
+    """
+    Translates the message head, and with batch translation the button labels
+    too in the same call
+    """
+    if not translation_batch_supported():
+        return handle_message_translation(message, user_id)
+    labels = [button["text"] for button in button_list]
+    translated = handle_batch_translation([message] + labels, user_id)
+    for button, text in zip(button_list, translated[1:]):
+        if text:
+            button["text"] = text
+    return translated[0]
+
 def ticket_attachment_invoke(file_type, itsm, user_id, client_id, email, text, thumb_url):
     ticket_data = {
         "itsm": itsm,
@@ -362,13 +626,33 @@ def ticket_attachment_invoke(file_type, itsm, user_id, client_id, email, text, t
         }
     }
 
-    logger.info(
-        f"Data being passed to ticketing function is: {ticket_data}")
-    lambda_client.invoke(FunctionName=os.environ.get("ticketing_handler_arn"),
-                            InvocationType="Event",
-                            Payload=json.dumps(ticket_data))
+    logger.info("Data being passed to ticketing function is: %s", ticket_data, extra=VERBOSE)
+    invoke_ticketing_handler(ticket_data)
+
+def invoke_ticketing_handler(data):
+    # Fires an async invoke of the ticketing function with the given data
+    payload = json.dumps(data)
+    with metrics_helper.span("lambda.ticketing") as call:
+        call.size = len(payload)
+        get_client("lambda").invoke(FunctionName=os.environ.get("ticketing_handler_arn"),
+                                    InvocationType="Event",
+                                    Payload=payload)
                             
-def handle_kendra_search(item_list: list, query: str, creds: dict, user_id: str, agent_name: str, im_channel: str, is_text: str, robot_jid: str, account_id: str, to_jid: str):
+def dispatch_ticket_attachments(attachment_jobs):
+    """
+    Invokes ticket_attachment_invoke for all attachments of a payload concurrently.
+    A failed attachment is logged and returned without stopping the others.
+    """
+    if not attachment_jobs:
+        return []
+    _, failures = fan_out(ticket_attachment_invoke, attachment_jobs)
+    for job, ex in failures:
+        logger.error(f"Couldn't send the attachment {job[-1]} to ticketing function: {ex}")
+    logger.info(f"Dispatched {len(attachment_jobs)} attachments, {len(failures)} failed")
+    attachment_jobs.clear()
+    return failures
+
+def handle_kendra_search(item_list: list, query: str, creds: dict, conversation: ConversationContext, agent_name: str, im_channel: str, is_text: str, robot_jid: str, account_id: str, to_jid: str):
     """
     When bot break or disamb message is sent it will query Kendra for results
     """
@@ -382,6 +666,6 @@ def handle_kendra_search(item_list: list, query: str, creds: dict, user_id: str,
                        "link":link
                     })
     # new_list.extend(item_list)
-    logger.info(new_list)
-    send_message_with_button_to_zoom(new_list, True, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name)
-    store_message_in_DB(message, user_id, agent_name)
\ No newline at end of file
+    logger.info("Kendra link buttons: %s", new_list, extra=VERBOSE)
+    deliver_message_with_button(conversation, new_list, True, is_text, item_list, creds, robot_jid, account_id, to_jid, message, True, agent_name)
+    store_message_in_DB(message, conversation, agent_name)
\ No newline at end of file
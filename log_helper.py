@@ -0,0 +1,126 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import reprlib
+import sys
+import time
+
+LOG_FORMAT = os.environ.get("log_format", "json").lower()
+LOG_LEVEL = os.environ.get("log_level", "INFO").upper()
+MAX_MESSAGE_CHARS = int(os.environ.get("log_max_message_chars", 2000))
+MAX_FIELD_CHARS = int(os.environ.get("log_max_field_chars", 300))
+VERBOSE_SAMPLE_RATE = float(os.environ.get("log_verbose_sample_rate", 0.05))
+
+# Pass as extra= to mark a record as verbose: it is only written for sampled events.
+VERBOSE = {"verbose": True}
+
+_event_fields = contextvars.ContextVar("log_event_fields", default={})
+_sampled = contextvars.ContextVar("log_sampled", default=True)
+
+_SECRET_VALUES = re.compile(
+    r"(?i)((?:authorization|access_token|token|zoom_auth|bot_chat_auth|password|secret)['\"]?\s*[:=]\s*['\"]?)"
+    r"(?:(?:Bearer|Basic)\s+)?[^'\",\s}]+")
+_SECRET_SCHEMES = re.compile(r"(Bearer|Basic)\s+[\w.~+/=-]+")
+
+_repr = reprlib.Repr()
+_repr.maxstring = MAX_FIELD_CHARS
+_repr.maxother = MAX_FIELD_CHARS
+_repr.maxdict = 20
+_repr.maxlist = 20
+_repr.maxlevel = 4
+
+
+def redact(text):
+    # Masks credentials and tokens that made it into a log message
+    return _SECRET_SCHEMES.sub(r"\1 ***", _SECRET_VALUES.sub(r"\1***", text))
+
+
+def _compact(value):
+    # reprlib stops after the configured sizes, so a huge item costs no more than a small one
+    if isinstance(value, str):
+        return value if len(value) <= MAX_FIELD_CHARS else f"{value[:MAX_FIELD_CHARS]}..."
+    if isinstance(value, (dict, list, tuple, set)):
+        return _repr.repr(value)
+    return value
+
+
+def render(record):
+    """
+    Builds the record's message from its %-style args, size-capped and redacted.
+    Only called for records that are actually written.
+    """
+    message = str(record.msg)
+    if record.args:
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        try:
+            message = message % tuple(_compact(arg) for arg in args)
+        except (TypeError, ValueError):
+            message = f"{message} {args}"
+    if len(message) > MAX_MESSAGE_CHARS:
+        message = f"{message[:MAX_MESSAGE_CHARS]}...[{len(message) - MAX_MESSAGE_CHARS} more chars]"
+    return redact(message)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Writes each record as one JSON line tagged with the current event's fields
+    """
+
+    def format(self, record):
+        document = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) +
+                    f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "message": render(record),
+        }
+        document.update(_event_fields.get())
+        if record.exc_info:
+            document["exception"] = redact(self.formatException(record.exc_info))
+        return json.dumps(document, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = f"[{record.levelname}] {render(record)}"
+        if record.exc_info:
+            text = f"{text}\n{redact(self.formatException(record.exc_info))}"
+        return text
+
+
+class VerboseSampler(logging.Filter):
+    # Drops verbose and debug records unless the current event was sampled
+    def filter(self, record):
+        if record.levelno < logging.INFO or getattr(record, "verbose", False):
+            return _sampled.get()
+        return True
+
+
+def configure():
+    """
+    Installs the formatter and sampler on the root logger's handlers
+    (the Lambda runtime's handler, or a stderr handler when run locally)
+    """
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    if not root.handlers:
+        root.addHandler(logging.StreamHandler(sys.stderr))
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+    for handler in root.handlers:
+        handler.setFormatter(formatter)
+        if not any(isinstance(existing, VerboseSampler) for existing in handler.filters):
+            handler.addFilter(VerboseSampler())
+
+
+def start_event(sampled=None, **fields):
+    """
+    Tags the following log lines with fields (event type, client, request id)
+    and decides whether this event's verbose records are written
+    """
+    if sampled is None:
+        sampled = random.random() < VERBOSE_SAMPLE_RATE
+    _event_fields.set({key: value for key, value in fields.items() if value is not None})
+    _sampled.set(sampled)
+    return sampled
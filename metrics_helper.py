@@ -0,0 +1,150 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+METRICS_NAMESPACE = os.environ.get("metrics_namespace", "ZoomOutboundHandler")
+METRICS_ENABLED = os.environ.get("metrics_enabled", "true").lower() not in ("0", "false", "no")
+# EMF accepts at most 100 values per metric in one log line
+MAX_VALUES = 100
+
+
+class MetricsCollector:
+    """
+    Aggregates dependency spans and counters for one invocation and writes
+    them as a single CloudWatch Embedded Metric Format line on flush
+    """
+
+    def __init__(self, **dimensions):
+        self.dimensions = {key: str(value) for key, value in dimensions.items() if value is not None}
+        self._latencies = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, duration_ms, status="ok", size=0):
+        failed = status == "error" or (isinstance(status, int) and status >= 400)
+        with self._lock:
+            latencies = self._latencies.setdefault(name, [])
+            if len(latencies) < MAX_VALUES:
+                latencies.append(round(duration_ms, 3))
+            self._add(f"{name}.calls", 1)
+            if failed:
+                self._add(f"{name}.errors", 1)
+            if size:
+                self._add(f"{name}.bytes", size)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._add(name, value)
+
+    def _add(self, name, value):
+        self._counts[name] = self._counts.get(name, 0) + value
+
+    def to_emf(self):
+        metrics = []
+        document = dict(self.dimensions)
+        for name, values in self._latencies.items():
+            metrics.append({"Name": f"{name}.latency", "Unit": "Milliseconds"})
+            document[f"{name}.latency"] = values
+        for name, value in self._counts.items():
+            unit = "Bytes" if name.endswith(".bytes") else "Count"
+            metrics.append({"Name": name, "Unit": unit})
+            document[name] = value
+        document["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [sorted(self.dimensions)],
+                "Metrics": metrics
+            }]
+        }
+        return document
+
+    def flush(self):
+        """
+        Writes the collected metrics to stdout as one EMF JSON line and resets them
+        """
+        with self._lock:
+            if not self._latencies and not self._counts:
+                return
+            line = json.dumps(self.to_emf())
+            self._latencies = {}
+            self._counts = {}
+        # EMF lines must be bare JSON, so they bypass the logging formatter.
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+_collector = contextvars.ContextVar("metrics_collector", default=MetricsCollector())
+
+
+def start_invocation(**dimensions):
+    """
+    Starts a new collector for the current invocation, tagged with the given dimensions
+    """
+    collector = MetricsCollector(**dimensions)
+    _collector.set(collector)
+    return collector
+
+
+def current():
+    return _collector.get()
+
+
+def set_dimension(name, value):
+    if value is not None:
+        current().dimensions[name] = str(value)
+
+
+def increment(name, value=1):
+    if METRICS_ENABLED:
+        current().increment(name, value)
+
+
+def flush():
+    if METRICS_ENABLED:
+        try:
+            current().flush()
+        except Exception as ex:
+            logger.error(f"Couldn't emit the metrics: {ex}")
+
+
+class span:
+    """
+    Times the enclosed call to a dependency. Set .status (e.g. an HTTP status code)
+    and .size (payload bytes) inside the block; an exception marks the call as an error.
+    """
+    __slots__ = ("name", "status", "size", "_start")
+
+    def __init__(self, name):
+        self.name = name
+        self.status = "ok"
+        self.size = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if METRICS_ENABLED:
+            duration_ms = (time.perf_counter() - self._start) * 1000
+            current().record(self.name, duration_ms, "error" if exc_type else self.status, self.size)
+        return False
+
+
+def timed(name):
+    # Decorator form of span for functions that raise on failure
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
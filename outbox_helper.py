@@ -0,0 +1,294 @@
+import logging
+import os
+import time
+import uuid
+import deadline_helper
+import metrics_helper
+from aws_helper import get_table
+from db_helper import get_creds
+from zoom_helper import post_chat_message
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# "direct" sends to Zoom on the webhook path, "outbox" queues the message for drain()
+DELIVERY_MODE = os.environ.get("zoom_delivery_mode", "direct").lower()
+SEQUENCE_ATTRIBUTE = "outbox_seq"
+BATCH_SIZE = int(os.environ.get("outbox_batch_size", 25))
+MAX_ATTEMPTS = int(os.environ.get("outbox_max_attempts", 5))
+LEASE_SECONDS = int(os.environ.get("outbox_lease_seconds", 60))
+# A drain renews its lease before sending once less than this is left on it
+LEASE_MARGIN_SECONDS = min(int(os.environ.get("outbox_lease_margin_seconds", 30)), LEASE_SECONDS / 2)
+# How long a missing seq (a queued write that never landed) may hold its conversation back
+GAP_SECONDS = int(os.environ.get("outbox_gap_seconds", 60))
+# seq 0 of every to_jid is its drain lease, messages start at 1
+LEASE_SEQ = 0
+
+drain_stats = {"sent": 0, "failed": 0, "dead": 0, "busy": 0, "skipped": 0}
+
+
+def is_enabled():
+    return DELIVERY_MODE == "outbox"
+
+
+def _get_table():
+    return get_table(os.environ.get("outbox_table"))
+
+
+def outbox_message(client_id, user_id, data, span_name, record_channel=False):
+    """
+    A queued Zoom message: the payload built by zoom_helper and what drain()
+    needs to send it. Creds are looked up again by client_id, never stored.
+    """
+    return {
+        "client_id": client_id,
+        "user_id": user_id,
+        "to_jid": data["to_jid"],
+        "data": data,
+        "span_name": span_name,
+        "record_channel": record_channel,
+        "attempts": 0,
+        "queued_at": int(time.time())
+    }
+
+
+def store(messages, last_seq):
+    """
+    Writes queued messages numbered up to last_seq, the conversation's
+    outbox_seq after the flush that reserved their numbers
+    """
+    first_seq = int(last_seq) - len(messages) + 1
+    try:
+        with metrics_helper.span("dynamodb.batch_write_item"):
+            with _get_table().batch_writer() as batch:
+                for offset, message in enumerate(messages):
+                    batch.put_item(Item=dict(message, seq=first_seq + offset))
+    except Exception as ex:
+        # Better late and in order than lost: send them on the webhook path after all
+        logger.error(f"Couldn't queue {len(messages)} messages, sending them directly: {ex}")
+        for message in messages:
+            _send(message)
+        return
+    metrics_helper.increment("outbox.queued", len(messages))
+    logger.info(f"Queued {len(messages)} messages for {messages[0]['to_jid']} from seq {first_seq}")
+
+
+def _acquire_lease(table, to_jid):
+    """
+    Takes the drain lease of to_jid: a new token on its seq 0 row, unless an
+    unexpired lease is held. Returns (token, lease row) or (None, None). The
+    row also keeps the drain cursor: next_seq, the next message to send, and
+    gap_since, when next_seq was first found missing (0 when it wasn't).
+    """
+    token = uuid.uuid4().hex
+    now = int(time.time())
+    try:
+        response = table.update_item(
+            Key={"to_jid": to_jid, "seq": LEASE_SEQ},
+            UpdateExpression="set #l=:until, #t=:token, #n=if_not_exists(#n, :first)",
+            ConditionExpression="attribute_not_exists(#l) OR #l < :now",
+            ExpressionAttributeNames={"#l": "lease_until", "#t": "lease_token", "#n": "next_seq"},
+            ExpressionAttributeValues={":until": now + LEASE_SECONDS, ":token": token,
+                                       ":first": LEASE_SEQ + 1, ":now": now},
+            ReturnValues="ALL_NEW")
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None, None
+    return token, response["Attributes"]
+
+
+def _save_cursor(table, to_jid, token, next_seq, gap_since):
+    """
+    Stores the cursor and renews the lease, if this drain still holds it.
+    Returns the new lease expiry, or None when the lease was lost.
+    """
+    lease_until = int(time.time()) + LEASE_SECONDS
+    try:
+        table.update_item(Key={"to_jid": to_jid, "seq": LEASE_SEQ},
+                          UpdateExpression="set #l=:until, #n=:next, #g=:gap",
+                          ConditionExpression="#t = :token",
+                          ExpressionAttributeNames={"#l": "lease_until", "#n": "next_seq",
+                                                    "#g": "gap_since", "#t": "lease_token"},
+                          ExpressionAttributeValues={":until": lease_until, ":next": next_seq,
+                                                     ":gap": gap_since, ":token": token})
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+    return lease_until
+
+
+def _release_lease(table, to_jid, token):
+    # Ends the lease but keeps the cursor; a lease taken over by another drain is left alone
+    try:
+        table.update_item(Key={"to_jid": to_jid, "seq": LEASE_SEQ},
+                          UpdateExpression="set #l=:zero",
+                          ConditionExpression="#t = :token",
+                          ExpressionAttributeNames={"#l": "lease_until", "#t": "lease_token"},
+                          ExpressionAttributeValues={":zero": 0, ":token": token})
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.error(f"Outbox lease of {to_jid} was taken over before it was released")
+
+
+def _pending(table, to_jid, next_seq):
+    # The next batch of queued messages of to_jid from next_seq on, in sequence order
+    with metrics_helper.span("dynamodb.query"):
+        response = table.query(KeyConditionExpression="#j = :j AND #s >= :next",
+                               ExpressionAttributeNames={"#j": "to_jid", "#s": "seq"},
+                               ExpressionAttributeValues={":j": to_jid, ":next": next_seq},
+                               Limit=BATCH_SIZE)
+    return response.get("Items", [])
+
+
+def _send(message):
+    creds = get_creds(message["client_id"])
+    if creds is None:
+        return None
+    data = message["data"]
+    return post_chat_message(creds, data.get("account_id", ""), data, message["span_name"])
+
+
+def _record_channel(message, response):
+    # The direct path stores the IM channel of the first message sent to a user
+    channel = response.json().get("channel")
+    if channel:
+        get_table(os.environ.get("zoom_mapping_table")).update_item(
+            Key={"user_id": message["user_id"]},
+            UpdateExpression="set #c=:c",
+            ExpressionAttributeNames={"#c": "im_channel"},
+            ExpressionAttributeValues={":c": channel})
+
+
+def _mark_failed(table, message, error):
+    """
+    Counts a failed attempt. Returns True when the message is now dead: it is
+    kept with status dead for inspection and no longer blocks the ones after it.
+    """
+    attempts = int(message.get("attempts", 0)) + 1
+    dead = attempts >= MAX_ATTEMPTS
+    table.update_item(Key={"to_jid": message["to_jid"], "seq": message["seq"]},
+                      UpdateExpression="set #a=:a, #e=:e, #st=:st",
+                      ExpressionAttributeNames={"#a": "attempts", "#e": "last_error", "#st": "status"},
+                      ExpressionAttributeValues={":a": attempts, ":e": str(error)[:500],
+                                                 ":st": "dead" if dead else "pending"})
+    return dead
+
+
+def drain_conversation(to_jid):
+    """
+    Sends the queued messages of one to_jid in sequence order.
+
+    The cursor on the lease row says which seq is next. Messages are written
+    after their numbers are reserved, so concurrent invocations can land them
+    out of order: a missing next seq holds the drain back until it arrives
+    (its INSERT triggers the next drain) or GAP_SECONDS have passed, after
+    which it is skipped. Each batch saves the cursor and renews the lease
+    before its messages are deleted. A failed message stops the drain and is
+    retried by the next one until it is dead. Stops early, without counting
+    an attempt, when the invocation runs out of time. Returns the number of
+    messages sent.
+    """
+    table = _get_table()
+    token, lease = _acquire_lease(table, to_jid)
+    if token is None:
+        drain_stats["busy"] += 1
+        logger.info(f"Outbox of {to_jid} is being drained elsewhere")
+        return 0
+    next_seq = int(lease["next_seq"])
+    gap_since = int(lease.get("gap_since") or 0)
+    lease_until = int(lease["lease_until"])
+    sent = 0
+    try:
+        while True:
+            batch = _pending(table, to_jid, next_seq)
+            if not batch:
+                break
+            delivered = []
+            blocked = False
+            for message in batch:
+                seq = int(message["seq"])
+                if seq > next_seq:
+                    now = int(time.time())
+                    gap_since = gap_since or now
+                    if now - gap_since < GAP_SECONDS:
+                        logger.info(f"Outbox of {to_jid} is waiting for seq {next_seq}")
+                        blocked = True
+                        break
+                    drain_stats["skipped"] += seq - next_seq
+                    metrics_helper.increment("outbox.gap_skipped", seq - next_seq)
+                    logger.error(f"Outbox of {to_jid} skipped seq {next_seq} to {seq - 1}, "
+                                 f"missing for {now - gap_since}s")
+                    next_seq = seq
+                gap_since = 0
+                if message.get("status") == "dead":
+                    next_seq = seq + 1
+                    continue
+                if not deadline_helper.current().allows_optional("outbox"):
+                    blocked = True
+                    break
+                if time.time() + LEASE_MARGIN_SECONDS > lease_until:
+                    # Renew before sending more; the rest of the batch is queried again
+                    break
+                try:
+                    response = _send(message)
+                    error = None if response is not None and response.status_code == 201 else \
+                        f"status {getattr(response, 'status_code', None)}"
+                except Exception as ex:
+                    response, error = None, ex
+                if error:
+                    drain_stats["failed"] += 1
+                    metrics_helper.increment("outbox.failed")
+                    logger.error(f"Couldn't send outbox message {to_jid}#{seq}: {error}")
+                    if not _mark_failed(table, message, error):
+                        blocked = True
+                        break
+                    drain_stats["dead"] += 1
+                    metrics_helper.increment("outbox.dead")
+                    next_seq = seq + 1
+                    continue
+                if message.get("record_channel"):
+                    _record_channel(message, response)
+                delivered.append(message)
+                next_seq = seq + 1
+            # The cursor goes first: a message behind it is never sent again, even if its delete is lost
+            lease_until = _save_cursor(table, to_jid, token, next_seq, gap_since)
+            if lease_until is None:
+                metrics_helper.increment("outbox.lease_lost")
+                logger.error(f"Lost the outbox lease of {to_jid}, stopping the drain")
+                return sent + len(delivered)
+            with metrics_helper.span("dynamodb.batch_write_item"):
+                with table.batch_writer() as writer:
+                    for message in delivered:
+                        writer.delete_item(Key={"to_jid": to_jid, "seq": message["seq"]})
+            sent += len(delivered)
+            drain_stats["sent"] += len(delivered)
+            metrics_helper.increment("outbox.sent", len(delivered))
+            if blocked:
+                break
+    except Exception:
+        _release_lease(table, to_jid, token)
+        raise
+    _release_lease(table, to_jid, token)
+    return sent
+
+
+def pending_conversations():
+    # Every to_jid with queued messages, for a scheduled sweep; lease rows alone don't count
+    table = _get_table()
+    to_jids = set()
+    scan_kwargs = {"ProjectionExpression": "#j, #s", "ExpressionAttributeNames": {"#j": "to_jid", "#s": "seq"}}
+    while True:
+        response = table.scan(**scan_kwargs)
+        to_jids.update(item["to_jid"] for item in response.get("Items", []) if int(item["seq"]) != LEASE_SEQ)
+        if "LastEvaluatedKey" not in response:
+            return sorted(to_jids)
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def stream_conversations(records):
+    # to_jids of the messages inserted in a DynamoDB stream batch of the outbox table
+    to_jids = []
+    for record in records:
+        keys = record.get("dynamodb", {}).get("Keys", {})
+        to_jid = keys.get("to_jid", {}).get("S")
+        is_lease = keys.get("seq", {}).get("N") == str(LEASE_SEQ)
+        if record.get("eventName") == "INSERT" and to_jid and not is_lease and to_jid not in to_jids:
+            to_jids.append(to_jid)
+    return to_jids
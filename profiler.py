@@ -1,20 +1,141 @@
 import cProfile
-import pstats
+import functools
 import io
 import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-def profile(func):
-    def wrapper(*args, **kwargs):
-        pr = cProfile.Profile()
-        pr.enable()
-        retval = func(*args, **kwargs)
-        pr.disable()
+
+# profiler_mode: off | always | sample | flag
+#   sample profiles 1 in profiler_sample_rate invocations,
+#   flag only profiles events carrying profiler_flag (top level, body or headers).
+# profiler_output: top | pstats | collapsed
+PROFILER_MODE = os.environ.get("profiler_mode", "off").lower()
+PROFILER_SAMPLE_RATE = max(int(os.environ.get("profiler_sample_rate", 100)), 1)
+PROFILER_FLAG = os.environ.get("profiler_flag", "x-profile")
+PROFILER_OUTPUT = os.environ.get("profiler_output", "top").lower()
+PROFILER_TOP_N = int(os.environ.get("profiler_top_n", 20))
+PROFILER_DUMP_DIR = os.environ.get("profiler_dump_dir", "/tmp")
+PROFILER_S3_BUCKET = os.environ.get("profiler_s3_bucket")
+PROFILER_INTERVAL = float(os.environ.get("profiler_interval_ms", 5)) / 1000
+
+
+def _should_profile(args):
+    if PROFILER_MODE == "always":
+        return True
+    if PROFILER_MODE == "sample":
+        return random.randrange(PROFILER_SAMPLE_RATE) == 0
+    if PROFILER_MODE == "flag":
+        event = args[0] if args and isinstance(args[0], dict) else {}
+        body = event.get("body") if isinstance(event.get("body"), dict) else {}
+        headers = event.get("headers") if isinstance(event.get("headers"), dict) else {}
+        return bool(event.get(PROFILER_FLAG) or body.get(PROFILER_FLAG) or headers.get(PROFILER_FLAG))
+    return False
+
+
+class StackSampler:
+    """
+    Samples the profiled thread's stack every interval from a background thread
+    and counts collapsed stacks ("outer;inner;leaf count") for flamegraphs
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+def _upload(path):
+    # Copies the dump to profiler_s3_bucket when configured, returns where it ended up
+    name = os.path.basename(path)
+    if PROFILER_S3_BUCKET:
+        from aws_helper import get_client
+        get_client("s3").upload_file(path, PROFILER_S3_BUCKET, f"profiles/{name}")
+        return f"s3://{PROFILER_S3_BUCKET}/profiles/{name}"
+    return path
+
+
+def _report(func_name, collector, wall_time, cpu_time):
+    timing = f"wall={wall_time * 1000:.1f}ms cpu={cpu_time * 1000:.1f}ms"
+    name = f"{func_name}-{int(time.time() * 1000)}"
+    if PROFILER_OUTPUT == "collapsed":
+        path = os.path.join(PROFILER_DUMP_DIR, f"{name}.collapsed")
+        with open(path, "w") as dump:
+            dump.write(collector.collapsed())
+        location = _upload(path)
+        logger.info(f"Profiling Results {timing} collapsed stacks written to {location}")
+    elif PROFILER_OUTPUT == "pstats":
+        path = os.path.join(PROFILER_DUMP_DIR, f"{name}.pstats")
+        collector.dump_stats(path)
+        location = _upload(path)
+        logger.info(f"Profiling Results {timing} pstats written to {location}")
+    else:
         s = io.StringIO()
         sortby = pstats.SortKey.CUMULATIVE  # 'cumulative'
-        ps = pstats.Stats(pr, stream=s).strip_dirs().sort_stats(sortby)
-        ps.print_stats(20)
-        logger.info(f"Profiling Results\n{s.getvalue()}")
-        return retval
+        ps = pstats.Stats(collector, stream=s).strip_dirs().sort_stats(sortby)
+        ps.print_stats(PROFILER_TOP_N)
+        logger.info(f"Profiling Results {timing}\n{s.getvalue()}")
+
+
+def profile(func):
+    """
+    Profiles the wrapped handler according to the profiler_* env variables.
+    With profiler_mode=off (the default) the function is returned unwrapped.
+    """
+    if PROFILER_MODE == "off":
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _should_profile(args):
+            return func(*args, **kwargs)
+        if PROFILER_OUTPUT == "collapsed":
+            collector = StackSampler()
+            start, stop = collector.start, collector.stop
+        else:
+            collector = cProfile.Profile()
+            start, stop = collector.enable, collector.disable
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stop()
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            try:
+                _report(func.__name__, collector, wall_time, cpu_time)
+            except Exception as ex:
+                logger.error(f"Couldn't write the profiling results: {ex}")
     return wrapper
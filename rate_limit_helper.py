@@ -0,0 +1,80 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` calls per second with bursts of `capacity`.
+    pause() holds every caller back, e.g. for a server's Retry-After.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, deadline=None):
+        """
+        Takes a token, sleeping until one is available.
+        Returns False without taking one when that would go past deadline (a monotonic time).
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key, rate, capacity):
+    # Returns the bucket for key, kept for the life of the container
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.setdefault(key, TokenBucket(rate, capacity))
+    return bucket
+
+
+def retry_after_seconds(response, attempt, base=0.5, cap=8.0):
+    """
+    Returns how long to wait before retrying a throttled response: the
+    Retry-After header (seconds or HTTP date) when present, else a jittered
+    exponential backoff
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            logger.info(f"Ignoring unparseable Retry-After: {retry_after}")
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
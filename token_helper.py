@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+import time
+
+import deadline_helper
+import http_helper
+import metrics_helper
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ZOOM_TOKEN_URL = os.environ.get("zoom_oauth_url", "https://zoom.us") + "/oauth/token?grant_type=client_credentials"
+
+
+class ZoomTokenManager:
+    """
+    Caches Zoom OAuth tokens per account/credentials for their expires_in lifetime.
+
+    Tokens live at module level so warm containers reuse them across invocations.
+    Only one thread refreshes a given key at a time; the others wait for its result.
+    """
+
+    def __init__(self, refresh_margin=None):
+        if refresh_margin is None:
+            refresh_margin = int(os.environ.get("zoom_token_refresh_margin", 300))
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.misses = 0
+        self._tokens = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def get_token(self, creds, account_id=""):
+        """
+        Returns a "Bearer ..." token for the creds, fetching a new one only when needed
+        """
+        basic_auth = _basic_auth_header(creds)
+        if not basic_auth:
+            logger.error("zoom_auth is missing in creds, can't generate the auth token")
+            return None
+        key = (account_id, basic_auth)
+
+        token = self._cached(key)
+        if token:
+            self.hits += 1
+            metrics_helper.increment("zoom_token.hits")
+            return token
+
+        with self._lock_for(key):
+            # Another thread may have refreshed the token while we were waiting.
+            token = self._cached(key)
+            if token:
+                self.hits += 1
+                return token
+            self.misses += 1
+            metrics_helper.increment("zoom_token.misses")
+            token, expires_in = _fetch_token(basic_auth)
+            if token:
+                self._tokens[key] = (token, time.monotonic() + expires_in)
+            return token
+
+    def invalidate(self, creds, account_id=""):
+        # Drops the cached token, e.g. after Zoom rejected it with a 401
+        self._tokens.pop((account_id, _basic_auth_header(creds)), None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "cached_tokens": len(self._tokens)}
+
+    def _cached(self, key):
+        entry = self._tokens.get(key)
+        if entry and time.monotonic() < entry[1] - self.refresh_margin:
+            return entry[0]
+        return None
+
+    def _lock_for(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+def _basic_auth_header(creds):
+    zoom_auth = (creds or {}).get("zoom_auth")
+    if not zoom_auth:
+        return None
+    if zoom_auth.startswith("Basic "):
+        return zoom_auth
+    return f"Basic {zoom_auth}"
+
+
+def _fetch_token(basic_auth):
+    # Requests a new client_credentials token from Zoom
+    headers = {"Authorization": basic_auth}
+    with metrics_helper.span("zoom.oauth") as call:
+        try:
+            response = http_helper.request("POST", ZOOM_TOKEN_URL, headers=headers,
+                                           deadline=deadline_helper.current(), dependency="zoom_token")
+        except Exception as ex:
+            if deadline_helper.is_timeout(ex):
+                deadline_helper.count_timeout("zoom_token")
+            raise
+        call.status = response.status_code
+    if response.status_code == 200:
+        body = response.json()
+        logger.info("Generated a new Zoom auth token")
+        return "Bearer " + body.get("access_token"), int(body.get("expires_in", 3600))
+    logger.error(f"Zoom token API returned unhandled status_code: {response.status_code}")
+    return None, 0
+
+
+token_manager = ZoomTokenManager()
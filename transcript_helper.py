@@ -0,0 +1,331 @@
+import codecs
+import logging
+import os
+import sys
+import zlib
+from datetime import datetime
+import metrics_helper
+from aws_helper import get_table
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+LEGACY_ATTRIBUTE = "chat_transcript"
+LINES_ATTRIBUTE = "chat_lines"
+TAIL_BYTES_ATTRIBUTE = "chat_tail_bytes"
+CHUNKS_ATTRIBUTE = "transcript_chunks"
+# Number of transcript lines that belong to resolved conversations
+OFFSET_ATTRIBUTE = "transcript_offset"
+# Set by anything that knows lines are missing, so resolution falls back to Haptik
+INCOMPLETE_ATTRIBUTE = "transcript_incomplete"
+CHUNK_BYTES = int(os.environ.get("transcript_chunk_bytes", 64 * 1024))
+COMPRESSION_LEVEL = int(os.environ.get("transcript_compression_level", 6))
+# What the handlers read from a mapping table item; the chunked store projects get_item onto these
+CONVERSATION_ATTRIBUTES = ("user_id", "robot_jid", "to_jid", "account_id", "im_channel",
+                           "agent_name", "email", "latest_message", OFFSET_ATTRIBUTE, INCOMPLETE_ATTRIBUTE)
+
+
+def format_line(message, agent_name, now=None):
+    # Formats a transcript line as "HH:MM:SS dd-mm-YYYY [agent]: text"
+    formatted_time = (now or datetime.now()).strftime("%H:%M:%S %d-%m-%Y")
+    return f"{formatted_time} [{agent_name}]: {message}"
+
+
+class StringTranscriptStore:
+    """
+    Legacy storage: the whole transcript is one string rewritten on every flush
+    """
+
+    def update_clause(self, item, lines):
+        chat_transcript = item.get(LEGACY_ATTRIBUTE)
+        if chat_transcript:
+            lines = [chat_transcript] + list(lines)
+        value = "\n".join(lines)
+        item[LEGACY_ATTRIBUTE] = value
+        return "#tr=:tr", {"#tr": LEGACY_ATTRIBUTE}, {":tr": value}
+
+    def read_lines(self, item):
+        chat_transcript = item.get(LEGACY_ATTRIBUTE)
+        if chat_transcript:
+            yield from chat_transcript.split("\n")
+
+
+class ListTranscriptStore:
+    """
+    Append-only storage: each line is a list element added with list_append.
+
+    The write carries only the new lines, so its size does not grow with the
+    conversation, and concurrent events for the same user can't overwrite each
+    other. Items that still hold a legacy chat_transcript string are read as
+    that string followed by the list, until migrate_item folds them together.
+    """
+
+    def update_clause(self, item, lines):
+        lines = list(lines)
+        item[LINES_ATTRIBUTE] = list(item.get(LINES_ATTRIBUTE) or []) + lines
+        return ("#tl=list_append(if_not_exists(#tl, :tl_empty), :tl)",
+                {"#tl": LINES_ATTRIBUTE},
+                {":tl": lines, ":tl_empty": []})
+
+    def read_lines(self, item):
+        chat_transcript = item.get(LEGACY_ATTRIBUTE)
+        if chat_transcript:
+            yield from chat_transcript.split("\n")
+        yield from item.get(LINES_ATTRIBUTE) or []
+
+
+def _line_bytes(line):
+    return len(line.encode()) + 1
+
+
+def pack_chunks(lines, chunk_bytes=CHUNK_BYTES):
+    """
+    Groups lines into chunks of at least chunk_bytes of text.
+    Returns (chunks, rest) where rest is too short to fill a chunk yet.
+    """
+    chunks = []
+    current, size = [], 0
+    for line in lines:
+        current.append(line)
+        size += _line_bytes(line)
+        if size >= chunk_bytes:
+            chunks.append(current)
+            current, size = [], 0
+    return chunks, current
+
+
+def encode_chunk(lines):
+    return zlib.compress("\n".join(lines).encode(), COMPRESSION_LEVEL)
+
+
+def decode_chunk(data, read_size=16 * 1024):
+    # Yields the lines of a compressed chunk, decompressing read_size bytes at a time
+    data = getattr(data, "value", data)  # boto3 wraps binary attributes in Binary
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    for start in range(0, len(data), read_size):
+        pending += decoder.decode(decompressor.decompress(data[start:start + read_size]))
+        *lines, pending = pending.split("\n")
+        yield from lines
+    pending += decoder.decode(decompressor.flush(), final=True)
+    yield from pending.split("\n")
+
+
+class ChunkedTranscriptStore:
+    """
+    Compressed storage for long conversations.
+
+    New lines are appended to the chat_lines tail of the mapping item as in
+    the list store. Once the tail holds transcript_chunk_bytes of text it is
+    zlib-compressed into rows of the transcript table, keyed (user_id,
+    chunk_no), and removed from the item. Items stay small however long the
+    conversation gets, and get_item is projected onto CONVERSATION_ATTRIBUTES,
+    so handlers never download the transcript. read_lines streams it back
+    chunk by chunk when the ticketing payload needs it.
+    """
+    projection = CONVERSATION_ATTRIBUTES + (TAIL_BYTES_ATTRIBUTE,)
+
+    def __init__(self, table=None, chunk_table=None, chunk_bytes=CHUNK_BYTES):
+        self.table = table
+        self.chunk_table = chunk_table
+        self.chunk_bytes = chunk_bytes
+
+    def _get_table(self):
+        return self.table or get_table(os.environ.get("zoom_mapping_table"))
+
+    def _get_chunk_table(self):
+        return self.chunk_table or get_table(os.environ.get("transcript_table"))
+
+    def update_clause(self, item, lines):
+        lines = list(lines)
+        added = sum(_line_bytes(line) for line in lines)
+        item[TAIL_BYTES_ATTRIBUTE] = int(item.get(TAIL_BYTES_ATTRIBUTE) or 0) + added
+        return ("#tl=list_append(if_not_exists(#tl, :tl_empty), :tl), #tb=if_not_exists(#tb, :tb_zero) + :tb",
+                {"#tl": LINES_ATTRIBUTE, "#tb": TAIL_BYTES_ATTRIBUTE},
+                {":tl": lines, ":tl_empty": [], ":tb": added, ":tb_zero": 0})
+
+    def after_flush(self, user_id, item):
+        # Seals the tail once it is big enough; a failed seal is retried by a later flush
+        if int(item.get(TAIL_BYTES_ATTRIBUTE) or 0) < self.chunk_bytes:
+            return
+        try:
+            self.seal(user_id)
+        except Exception as ex:
+            logger.error(f"Couldn't seal the transcript of user: {user_id}: {ex}")
+
+    def seal(self, user_id):
+        """
+        Moves the full chunks of the tail into the transcript table.
+
+        The item update is conditional on the tail being unchanged, so lines
+        appended concurrently are never lost; they are sealed next time.
+        Returns the number of chunks sealed.
+        """
+        table = self._get_table()
+        with metrics_helper.span("dynamodb.get_item"):
+            head = table.get_item(Key={"user_id": user_id},
+                                  ProjectionExpression="#tl, #tc",
+                                  ExpressionAttributeNames={"#tl": LINES_ATTRIBUTE, "#tc": CHUNKS_ATTRIBUTE},
+                                  ConsistentRead=True).get("Item", {})
+        tail = head.get(LINES_ATTRIBUTE) or []
+        chunks, rest = pack_chunks(tail, self.chunk_bytes)
+        if not chunks:
+            return 0
+        first_chunk = int(head.get(CHUNKS_ATTRIBUTE) or 0)
+        chunk_table = self._get_chunk_table()
+        for offset, chunk in enumerate(chunks):
+            data = encode_chunk(chunk)
+            with metrics_helper.span("dynamodb.put_item") as call:
+                call.size = len(data)
+                chunk_table.put_item(Item={"user_id": user_id, "chunk_no": first_chunk + offset,
+                                           "data": data, "line_count": len(chunk)})
+        try:
+            with metrics_helper.span("dynamodb.update_item"):
+                table.update_item(
+                    Key={"user_id": user_id},
+                    UpdateExpression="set #tl=:rest, #tb=:rest_bytes, #tc=:chunks",
+                    ConditionExpression="#tl = :sealed",
+                    ExpressionAttributeNames={"#tl": LINES_ATTRIBUTE, "#tb": TAIL_BYTES_ATTRIBUTE,
+                                              "#tc": CHUNKS_ATTRIBUTE},
+                    ExpressionAttributeValues={":rest": rest,
+                                               ":rest_bytes": sum(_line_bytes(line) for line in rest),
+                                               ":chunks": first_chunk + len(chunks),
+                                               ":sealed": tail})
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            # Chunk rows past transcript_chunks are unreferenced and get overwritten by the next seal
+            logger.info(f"Transcript of user: {user_id} changed while sealing, retrying on a later flush")
+            return 0
+        logger.info(f"Sealed {len(chunks)} transcript chunks of user: {user_id}")
+        return len(chunks)
+
+    def read_lines(self, item):
+        """
+        Streams the legacy string, the sealed chunks and the tail, in order.
+        The tail and chunk count are read together, so a concurrent seal
+        can't make lines appear twice or go missing.
+        """
+        user_id = item["user_id"]
+        with metrics_helper.span("dynamodb.get_item"):
+            head = self._get_table().get_item(
+                Key={"user_id": user_id},
+                ProjectionExpression="#tr, #tl, #tc",
+                ExpressionAttributeNames={"#tr": LEGACY_ATTRIBUTE, "#tl": LINES_ATTRIBUTE,
+                                          "#tc": CHUNKS_ATTRIBUTE},
+                ConsistentRead=True).get("Item", {})
+        chat_transcript = head.get(LEGACY_ATTRIBUTE)
+        if chat_transcript:
+            yield from chat_transcript.split("\n")
+        chunk_count = int(head.get(CHUNKS_ATTRIBUTE) or 0)
+        if chunk_count:
+            yield from self._read_chunks(user_id, chunk_count)
+        yield from head.get(LINES_ATTRIBUTE) or []
+
+    def _read_chunks(self, user_id, chunk_count):
+        query_kwargs = {"KeyConditionExpression": "#u = :u AND #c < :count",
+                        "ExpressionAttributeNames": {"#u": "user_id", "#c": "chunk_no"},
+                        "ExpressionAttributeValues": {":u": user_id, ":count": chunk_count}}
+        while True:
+            with metrics_helper.span("dynamodb.query"):
+                response = self._get_chunk_table().query(**query_kwargs)
+            for chunk in response.get("Items", []):
+                yield from decode_chunk(chunk["data"])
+            if "LastEvaluatedKey" not in response:
+                break
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+TRANSCRIPT_STORES = {
+    "string": StringTranscriptStore,
+    "list": ListTranscriptStore,
+    "chunked": ChunkedTranscriptStore,
+}
+
+
+def get_transcript_store(mode=None):
+    """
+    Returns the transcript store configured by the transcript_mode env variable
+    """
+    mode = mode or os.environ.get("transcript_mode", "list")
+    try:
+        return TRANSCRIPT_STORES[mode]()
+    except KeyError:
+        logger.error(f"Unsupported transcript_mode: {mode}, falling back to list")
+        return ListTranscriptStore()
+
+
+def migrate_item(table, item):
+    """
+    Moves a legacy chat_transcript string into the chat_lines list.
+
+    The legacy lines are prepended so they stay ahead of anything appended
+    since, and the update is conditional on the string being unchanged. The
+    record is flagged incomplete: where its current conversation starts is
+    unknown until it is next resolved.
+    """
+    chat_transcript = item.get(LEGACY_ATTRIBUTE)
+    if not isinstance(chat_transcript, str):
+        return False
+    try:
+        table.update_item(
+            Key={"user_id": item["user_id"]},
+            UpdateExpression="set #tl=list_append(:legacy, if_not_exists(#tl, :tl_empty)), #ti=:ti remove #tr",
+            ConditionExpression="#tr = :current",
+            ExpressionAttributeNames={"#tl": LINES_ATTRIBUTE, "#tr": LEGACY_ATTRIBUTE, "#ti": INCOMPLETE_ATTRIBUTE},
+            ExpressionAttributeValues={
+                ":legacy": chat_transcript.split("\n") if chat_transcript else [],
+                ":tl_empty": [],
+                ":ti": True,
+                ":current": chat_transcript
+            })
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"Transcript of user: {item['user_id']} changed during migration, skipping")
+        return False
+    return True
+
+
+def migrate_table(table):
+    # Migrates every item of the mapping table that still has a string transcript
+    migrated = 0
+    scan_kwargs = {"ProjectionExpression": "user_id, #tr",
+                   "FilterExpression": "attribute_exists(#tr)",
+                   "ExpressionAttributeNames": {"#tr": LEGACY_ATTRIBUTE}}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            migrated += migrate_item(table, item)
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    logger.info(f"Migrated {migrated} string transcripts to {LINES_ATTRIBUTE}")
+    return migrated
+
+
+def seal_table(table, store=None):
+    # Seals the chat_lines of every item that has at least one full chunk of them
+    store = store or ChunkedTranscriptStore(table=table)
+    sealed = 0
+    scan_kwargs = {"ProjectionExpression": "user_id",
+                   "FilterExpression": "attribute_exists(#tl)",
+                   "ExpressionAttributeNames": {"#tl": LINES_ATTRIBUTE}}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            sealed += store.seal(item["user_id"])
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    logger.info(f"Sealed {sealed} transcript chunks")
+    return sealed
+
+
+if __name__ == "__main__":
+    # python transcript_helper.py migrate <zoom_mapping_table>
+    # python transcript_helper.py seal <zoom_mapping_table>   (needs the transcript_table env variable)
+    logging.basicConfig()
+    if len(sys.argv) != 3 or sys.argv[1] not in ("migrate", "seal"):
+        sys.exit("usage: python transcript_helper.py migrate|seal <table_name>")
+    if sys.argv[1] == "migrate":
+        migrate_table(get_table(sys.argv[2]))
+    else:
+        seal_table(get_table(sys.argv[2]))
@@ -1,24 +1,126 @@
-import boto3
 import json
 import logging
 import os
+from cache_helper import TTLCache
+import breaker_helper
+import deadline_helper
+import metrics_helper
+from aws_helper import get_client
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-lambda_client = boto3.client("lambda")
+# The translation service resolves the target language from the user, so entries are per user.
+translation_cache = TTLCache("translation",
+                             max_size=int(os.environ.get("translation_cache_max_size", 2048)),
+                             ttl=int(os.environ.get("translation_cache_ttl_seconds", 3600)))
+# Only for a translation service that accepts a "messages" list and answers with
+# "translated_messages"; the current one translates a single "message"
+TRANSLATION_BATCH_ENABLED = os.environ.get("translation_batch_enabled", "false").lower() == "true"
+# Set once the service answered a batch without "translated_messages", for the life of the container
+_batch_unsupported = False
+
+
+def batch_supported():
+    return TRANSLATION_BATCH_ENABLED and not _batch_unsupported
+
+
+def _invoke_translation(payload):
+    """
+    Invokes the translation service. Returns None instead of its response when
+    the invocation is short on time, the call timed out or the service's
+    circuit is open, so callers send the text untranslated.
+    """
+    deadline = deadline_helper.current()
+    if not deadline.allows_optional("translation"):
+        return None
+    try:
+        deadline.budget("translation")
+        with breaker_helper.get_breaker("translation").guard():
+            return _call_translation(payload)
+    except breaker_helper.CircuitOpenError:
+        logger.info("Translation's circuit is open, sending the message untranslated")
+        return None
+    except Exception as ex:
+        if not deadline_helper.is_timeout(ex):
+            raise
+        deadline_helper.count_timeout("translation")
+        logger.error(f"Translation timed out, sending the message untranslated: {ex}")
+        return None
+
+
+def _call_translation(payload):
+    payload = json.dumps(payload)
+    with metrics_helper.span("lambda.translation") as call:
+        call.size = len(payload)
+        response = get_client("lambda", budget="translation").invoke(
+            FunctionName=os.environ.get("translation_service_arn"),
+            InvocationType="RequestResponse",
+            Payload=payload)
+        response = json.load(response.get("Payload"))
+    logger.debug("Response of translation service is: %s", response)
+    return response
 
 
 def handle_message_translation(message, user_id):
+    cache_key = (user_id, message)
+    translated_message = translation_cache.get(cache_key)
+    if translated_message is not None:
+        return translated_message
+
     payload = {
         "message": message,
         "user_id": user_id,
         "source": "agent"
     }
-    response = lambda_client.invoke(FunctionName=os.environ.get("translation_service_arn"),
-                                    InvocationType="RequestResponse",
-                                    Payload=json.dumps(payload))
-    response = json.load(response.get("Payload"))
-    logger.debug(f"Response of translation service is: {response}")
+    response = _invoke_translation(payload)
+    if response is None:
+        return message
+    translated_message = response.get("translated_message")
+    if translated_message is not None:
+        translation_cache.set(cache_key, translated_message)
+    return translated_message
+
+
+def handle_batch_translation(messages, user_id):
+    """
+    Translates several strings for the user with at most one invoke.
+
+    Cached strings are not sent. The rest go in a single payload with a
+    "messages" list. If the service doesn't answer with "translated_messages",
+    batches are turned off for the container and the originals are returned.
+    Results keep the input order. Callers check batch_supported() first.
+    """
+    global _batch_unsupported
+    translated = [translation_cache.get((user_id, message)) for message in messages]
+    pending = list(dict.fromkeys(message for message, result in zip(messages, translated)
+                                 if result is None))
+    if not pending:
+        return translated
+
+    if len(pending) == 1:
+        results = {pending[0]: handle_message_translation(pending[0], user_id)}
+    else:
+        payload = {
+            "messages": pending,
+            "user_id": user_id,
+            "source": "agent"
+        }
+        response = _invoke_translation(payload) or {}
+        translated_messages = response.get("translated_messages")
+        if not response:
+            # Skipped or timed out: send the originals
+            results = {message: message for message in pending}
+        elif isinstance(translated_messages, list) and len(translated_messages) == len(pending):
+            results = dict(zip(pending, translated_messages))
+            for message, translated_message in results.items():
+                if translated_message is not None:
+                    translation_cache.set((user_id, message), translated_message)
+        else:
+            logger.error("Translation service didn't return a batch response, turning batches off")
+            _batch_unsupported = True
+            metrics_helper.increment("translation.batch_unsupported")
+            results = {message: message for message in pending}
 
-    return response.get("translated_message")
\ No newline at end of file
+    return [results[message] if result is None else result
+            for message, result in zip(messages, translated)]